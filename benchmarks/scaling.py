@@ -0,0 +1,87 @@
+"""Benchmark the create and destroy commands against a local fake API
+
+Starts a kovh.fakeapi server with the given behaviour, then creates and
+destroys clusters of increasing size through it, reporting the duration of
+every command and the number of API requests it sent. Local data (key pool,
+cluster index, cache) is kept in a temporary directory.
+
+Usage:
+  scaling.py [-s SIZES] [-k TYPE] [-p NUM] [-l SECS] [-e RATE] [-r NUM] [-b SECS] [-d SECS]
+  scaling.py -h | --help
+
+Options:
+  -s, --sizes SIZES       Comma-separated cluster sizes [default: 1,10,50,100]
+  -k, --key-type TYPE     Type of cluster keys, rsa2048 or ecdsa-p256 [default: rsa2048]
+  -p, --parallelism NUM   Number of concurrent instance creations and deletions [default: 8]
+  -l, --latency SECS      Delay added to every API response [default: 0.05]
+  -e, --error-rate RATE   Fraction of API requests failing with HTTP 503 [default: 0]
+  -r, --rate-limit NUM    API requests accepted per second, 0 for no limit [default: 0]
+  -b, --build-time SECS   Time before instances and networks become ACTIVE [default: 1]
+  -d, --delete-time SECS  Time before deleted instances vanish [default: 1]
+  -h, --help              Show this screen
+"""
+
+from contextlib import redirect_stdout
+from docopt     import docopt
+from os         import devnull, environ
+from tempfile   import TemporaryDirectory
+from time       import perf_counter
+
+from kovh.client  import Client
+from kovh.fakeapi import FakeAPI, serve, PROJECT
+from kovh.main    import create_command, destroy_command
+from kovh.utils   import columns
+
+
+def run(command, client, args):
+    """Run a kovh command silently, return its duration and whether it succeeded"""
+
+    start = perf_counter()
+    try:
+        with open(devnull, 'w') as out, redirect_stdout(out):
+            command(client, args)
+    except SystemExit as e:
+        return perf_counter() - start, not e.code
+
+    return perf_counter() - start, True
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    with TemporaryDirectory() as tmp:
+        environ['XDG_DATA_HOME'] = environ['XDG_CACHE_HOME'] = tmp
+
+        api = FakeAPI(float(args['--latency']), float(args['--error-rate']), int(args['--rate-limit']),
+                      float(args['--build-time']), float(args['--delete-time']))
+        server = serve(api)
+        environ['OVH_API_URL'] = 'http://127.0.0.1:{}/1.0'.format(server.server_port)
+
+        rows = []
+        for size in [int(s) for s in args['--sizes'].split(',')]:
+            client = Client(endpoint='ovh-eu', application_key='fake', application_secret='fake',
+                            consumer_key='fake', project=PROJECT, region='GRA1', sshkey='fakekey',
+                            flavor='b2-7-GRA1')
+            name = 'bench{}'.format(size)
+
+            requests = api.requests
+            create_time, created = run(create_command, client, ['-n', name, '-s', str(size), '-k', args['--key-type'],
+                                                                '-p', args['--parallelism'], '--cidr', '192.168.0.0/20'])
+            create_requests = api.requests - requests
+
+            requests = api.requests
+            destroy_time, destroyed = run(destroy_command, client, ['-n', name, '-p', args['--parallelism']])
+            destroy_requests = api.requests - requests
+
+            rows.append((
+                size,
+                '{:.2f}'.format(create_time) + ('' if created else ' (failed)'),
+                create_requests,
+                '{:.2f}'.format(destroy_time) + ('' if destroyed else ' (failed)'),
+                destroy_requests
+            ))
+            print('Cluster of {} instances\t[OK]'.format(size), flush=True)
+
+        server.shutdown()
+
+    print(columns(['SIZE', 'CREATE (s)', 'CREATE REQUESTS', 'DESTROY (s)', 'DESTROY REQUESTS'], rows))
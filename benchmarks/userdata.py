@@ -0,0 +1,137 @@
+"""Benchmark the generation of cluster User Data
+
+Runs the pipeline of the 'create' and 'render' commands offline for
+clusters of increasing size and reports the time spent in every stage,
+together with the peak memory usage. Certificates are issued in-process so
+that key generation and signing can be timed separately.
+
+Usage:
+  userdata.py [-s SIZES] [-k TYPE]
+  userdata.py -h | --help
+
+Options:
+  -s, --sizes SIZES     Comma-separated cluster sizes [default: 1,10,100,500]
+  -k, --key-type TYPE   Type of cluster keys, rsa2048 or ecdsa-p256 [default: rsa2048]
+  -h, --help            Show this screen
+"""
+
+from docopt    import docopt
+from functools import wraps
+from ipaddress import IPv4Network
+from time      import perf_counter
+import tracemalloc
+
+import kovh.ca
+import kovh.host
+import kovh.userdata
+from kovh.infra    import IPAllocator
+from kovh.userdata import Fragments
+from kovh.utils    import columns
+
+
+# functions timed wherever they are called, as (module, attribute, stage)
+PROBES = [
+    (kovh.ca, '_new_key', 'key generation'),
+    (kovh.ca, '_sign_cert', 'certificate signing'),
+    (kovh.userdata, 'compress', 'gzip'),
+    (kovh.userdata, 'quote', 'quote'),
+    (kovh.userdata, 'dumps', 'json.dumps'),
+    (kovh.host, 'dumps', 'json.dumps')
+]
+
+STAGES = ['CA creation', 'key generation', 'certificate signing', 'manifest rendering', 'gzip', 'quote', 'json.dumps']
+
+
+def probe(func, stage, timings):
+    """Wrap func to add its duration to the timings of stage"""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[stage] = timings.get(stage, 0) + perf_counter() - start
+
+    return wrapper
+
+def render(size, key_type, timings=None):
+    """Generate the User Data of a cluster
+
+    Returns the duration of the CA creation, of the rendering and in total.
+    Timings recorded during the CA creation are discarded from 'timings'.
+    """
+    ips = IPAllocator(IPv4Network('192.168.0.0/20')).allocate(size)
+
+    start = perf_counter()
+    ca = kovh.ca.CA(key_type)
+    ca_done = perf_counter()
+    if timings is not None:
+        timings.clear()
+
+    pki = ca.issue_batch(
+        [kovh.host.Host.pki_request(['master', 'node'], ips[0])] +
+        [kovh.host.Host.pki_request(['node'], ip) for ip in ips[1:]],
+        workers=1
+    )
+    pki_done = perf_counter()
+
+    master, nodes = kovh.host.make_cluster('kovh:bench:', ips, None, None, ca, pki, Fragments(), 'image')
+    for h in [master] + nodes:
+        h.userdata_size()
+        h.make_body()
+    done = perf_counter()
+
+    return ca_done - start, done - pki_done, done - start
+
+def run(size, key_type):
+    """Return the timings of every stage and the total duration for a cluster of the given size"""
+
+    timings = {}
+    originals = [(module, attr, getattr(module, attr)) for module, attr, _ in PROBES]
+    for module, attr, stage in PROBES:
+        setattr(module, attr, probe(getattr(module, attr), stage, timings))
+
+    try:
+        ca_time, render_time, total = render(size, key_type, timings)
+    finally:
+        for module, attr, func in originals:
+            setattr(module, attr, func)
+
+    timings['CA creation'] = ca_time
+    # rendering excludes the encoding and serialization stages it triggers
+    timings['manifest rendering'] = render_time - sum(timings.get(s, 0) for s in ('gzip', 'quote', 'json.dumps'))
+
+    return timings, total
+
+def peak_memory(size, key_type):
+    """Return the peak memory allocated while generating a cluster, in bytes
+
+    Measured in a separate run since tracing allocations slows everything down.
+    """
+    tracemalloc.start()
+    try:
+        render(size, key_type)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+
+    sizes = [int(s) for s in args['--sizes'].split(',')]
+
+    rows = []
+    for size in sizes:
+        timings, total = run(size, args['--key-type'])
+        peak = peak_memory(size, args['--key-type'])
+
+        rows.append(
+            [size] +
+            ['{:.3f}'.format(timings.get(s, 0)) for s in STAGES] +
+            ['{:.3f}'.format(total), '{:.1f}'.format(peak / 2**20)]
+        )
+        print('Cluster of {} instances\t[OK]'.format(size), flush=True)
+
+    print(columns(['SIZE'] + [s.upper() for s in STAGES] + ['TOTAL', 'PEAK MEM (MiB)'], rows))
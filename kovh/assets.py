@@ -0,0 +1,59 @@
+from hashlib   import sha256, sha512, md5
+from requests  import Session
+from threading import Lock
+
+
+class AssetStore:
+    """Content-addressed store for cluster-wide User Data assets
+
+    Assets are uploaded once to a container of an OpenStack Swift compatible
+    object storage, named after the SHA-256 digest of their content, and
+    referenced from the Ignition config of every instance instead of being
+    embedded inline. The container must be readable by the instances.
+
+    Arguments:
+    url -- URL of the container, e.g. https://storage.gra.cloud.ovh.net/v1/AUTH_<project>/<container>
+    token -- optional authentication token sent in the X-Auth-Token header
+    """
+
+    def __init__(self, url, token=None):
+        self.url = url.rstrip('/')
+        self.uploaded = 0
+        self.reused = 0
+
+        self._session = Session()
+        if token:
+            self._session.headers['X-Auth-Token'] = token
+        self._lock = Lock()
+
+    def put(self, data):
+        """Upload data unless already present, return its URL"""
+
+        url = '{}/{}'.format(self.url, sha256(data).hexdigest())
+
+        if self._session.head(url).status_code == 200:
+            with self._lock:
+                self.reused += 1
+            return url
+
+        # Swift verifies the integrity of the upload against the ETag header
+        r = self._session.put(url, data=data, headers={'ETag': md5(data).hexdigest()})
+        r.raise_for_status()
+
+        with self._lock:
+            self.uploaded += 1
+
+        return url
+
+    def contents(self, data):
+        """Upload data and return the Ignition 'contents' definition referencing it
+
+        Ignition 2.x only verifies SHA-512 digests, objects are therefore
+        addressed by SHA-256 but verified using SHA-512.
+        """
+        contents = {
+            'source': self.put(data),
+            'verification': {'hash': 'sha512-' + sha512(data).hexdigest()}
+        }
+
+        return contents
@@ -1,4 +1,16 @@
-from OpenSSL import crypto
+from OpenSSL                                   import crypto
+from cryptography.hazmat.backends              import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec
+from collections                               import OrderedDict
+from concurrent.futures                        import ProcessPoolExecutor
+from itertools                                 import repeat
+from threading                                 import Lock
+
+
+_serial_lock = Lock()
+
+# supported key types
+KEY_TYPES = ('rsa2048', 'ecdsa-p256')
 
 
 class CA:
@@ -10,14 +22,20 @@ class CA:
 
     __next_serial = 1000
 
-    def __init__(self):
+    def __init__(self, key_type='rsa2048', keypool=None):
+        if key_type not in KEY_TYPES:
+            raise ValueError("key type must be one of {}, not '{}'".format(', '.join(KEY_TYPES), key_type))
+        self.key_type = key_type
+
+        # optional source of pre-generated keys, must hold keys of the same type
+        self.keypool = keypool
+
         # CA key
-        key = crypto.PKey()
-        key.generate_key(crypto.TYPE_RSA, 2048)
+        key = self.create_key()
 
         # CA cert
         cert = crypto.X509()
-        cert.set_serial_number(self.__next_serial)
+        cert.set_serial_number(self._reserve_serials(1))
         cert.set_version(2)
         cert.set_pubkey(key)
         cert.gmtime_adj_notBefore(0)
@@ -39,151 +57,197 @@ class CA:
         # sign CA cert with CA key
         cert.sign(key, 'sha256')
 
-        type(self).__next_serial += 1
-
         self.cert = cert
         self.key = key
 
-    def create_key(self):
-        """Issue a X.509 key"""
+    def dump(self, passphrase):
+        """Serialize the CA to a dict, for another process to issue certificates
 
-        key = crypto.PKey()
-        key.generate_key(crypto.TYPE_RSA, 2048)
-        return key
+        The key is encrypted with 'passphrase'. The next serial number is
+        recorded too, certificates issued later must not reuse serial numbers.
+        """
+        passphrase = passphrase.encode() if isinstance(passphrase, str) else passphrase
 
-    def create_client_cert(self, key, o, cn):
-        """Issue a X.509 client certificate"""
+        return {
+            'key_type': self.key_type,
+            'cert': crypto.dump_certificate(crypto.FILETYPE_PEM, self.cert).decode(),
+            'key': crypto.dump_privatekey(crypto.FILETYPE_PEM, self.key, 'aes256', passphrase).decode(),
+            'next_serial': self._reserve_serials(0)
+        }
 
-        cert = crypto.X509()
-        cert.set_serial_number(self.__next_serial)
-        cert.set_version(2)
-        cert.set_pubkey(key)
-        cert.gmtime_adj_notBefore(0)
-        cert.gmtime_adj_notAfter(365*24*60*60)
+    @classmethod
+    def load(cls, record, passphrase, keypool=None):
+        """Restore a CA serialized by dump()
 
-        cert_subject = cert.get_subject()
-        cert_subject.O = o
-        cert_subject.OU = 'kOVHernetes'
-        cert_subject.CN = cn
-        cert.set_issuer(self.cert.get_issuer())
+        Raises OpenSSL.crypto.Error if the key can't be decrypted with 'passphrase'.
+        """
+        passphrase = passphrase.encode() if isinstance(passphrase, str) else passphrase
 
-        cert_ext = []
-        cert_ext.append(crypto.X509Extension(b'subjectKeyIdentifier', False, b'hash', cert))
-        cert_ext.append(crypto.X509Extension(b'authorityKeyIdentifier', False, b'keyid,issuer', issuer=self.cert))
-        cert_ext.append(crypto.X509Extension(b'basicConstraints', False, b'CA:FALSE'))
-        cert_ext.append(crypto.X509Extension(b'keyUsage', True, b'nonRepudiation, digitalSignature, keyEncipherment'))
-        cert_ext.append(crypto.X509Extension(b'extendedKeyUsage', True, b'clientAuth'))
-        cert.add_extensions(cert_ext)
+        ca = cls.__new__(cls)
+        ca.key_type = record['key_type']
+        ca.keypool = keypool
+        ca.cert = crypto.load_certificate(crypto.FILETYPE_PEM, record['cert'].encode())
+        ca.key = crypto.load_privatekey(crypto.FILETYPE_PEM, record['key'].encode(), passphrase)
+
+        # resume numbering after the certificates issued so far
+        with _serial_lock:
+            CA.__next_serial = max(CA.__next_serial, record['next_serial'])
+
+        return ca
+
+    def create_key(self):
+        """Issue a X.509 key
 
-        # sign cert with CA key
-        cert.sign(self.key, 'sha256')
+        Drawn from the key pool when available, generated inline otherwise.
+        """
+        if self.keypool is not None:
+            for key in self.keypool.take():
+                return key
 
-        type(self).__next_serial += 1
+        return _new_key(self.key_type)
 
+    def create_client_cert(self, key, o, cn):
+        """Issue a X.509 client certificate"""
+
+        cert = _sign_cert(self.cert, self.key, key, self._reserve_serials(1), 'client', o, cn)
         return cert
 
     def create_server_cert(self, key, o, cn, san=[]):
         """Issue a X.509 server certificate"""
 
-        cert = crypto.X509()
-        cert.set_serial_number(self.__next_serial)
-        cert.set_version(2)
-        cert.set_pubkey(key)
-        cert.gmtime_adj_notBefore(0)
-        cert.gmtime_adj_notAfter(365*24*60*60)
+        cert = _sign_cert(self.cert, self.key, key, self._reserve_serials(1), 'server', o, cn, san)
+        return cert
 
-        cert_subject = cert.get_subject()
-        cert_subject.O = o
-        cert_subject.OU = 'kOVHernetes'
-        cert_subject.CN = cn
-        cert.set_issuer(self.cert.get_issuer())
+    def create_client_pair(self, o, cn):
+        """Issue a X.509 client key/certificate pair"""
 
-        cert_ext = []
-        cert_ext.append(crypto.X509Extension(b'subjectKeyIdentifier', False, b'hash', cert))
-        cert_ext.append(crypto.X509Extension(b'authorityKeyIdentifier', False, b'keyid,issuer:always', issuer=self.cert))
-        cert_ext.append(crypto.X509Extension(b'basicConstraints', False, b'CA:FALSE'))
-        cert_ext.append(crypto.X509Extension(b'keyUsage', True, b'digitalSignature, keyEncipherment'))
-        cert_ext.append(crypto.X509Extension(b'extendedKeyUsage', True, b'serverAuth'))
-        if san:
-            cert_ext.append(crypto.X509Extension(b'subjectAltName', False, ','.join(san).encode()))
-        cert.add_extensions(cert_ext)
+        key = self.create_key()
+        cert = self.create_client_cert(key, o, cn)
+        return key, cert
+
+    def create_server_pair(self, o, cn, san=[]):
+        """Issue a X.509 server key/certificate pair"""
 
-        # sign cert with CA key
-        cert.sign(self.key, 'sha256')
+        key = self.create_key()
+        cert = self.create_server_cert(key, o, cn, san)
+        return key, cert
 
-        type(self).__next_serial += 1
+    def issue(self, request):
+        """Issue a key and the certificates of a single request
 
-        return cert
+        A request is a list of (name, kind, o, cn, san) tuples, where kind is
+        either 'client' or 'server'. All certificates of a request share the
+        same key. Returns a (key_pem, {name: cert_pem}) tuple.
+        """
+        return _issue(self.cert, self.key, request, self._reserve_serials(len(request)), self.create_key(), self.key_type)
 
-    def create_client_pair(self, o, cn):
-        """Issue a X.509 client key/certificate pair"""
+    def issue_batch(self, requests, workers=None):
+        """Issue keys and certificates for many requests in a process pool
 
-        # key
-        key = crypto.PKey()
-        key.generate_key(crypto.TYPE_RSA, 2048)
+        Key generation and signing are CPU-bound, requests are therefore
+        distributed across 'workers' processes (default: number of CPUs).
+        Results are returned in request order, see issue() for their format.
+        """
+        serials = [self._reserve_serials(len(r)) for r in requests]
 
-        # cert
-        cert = crypto.X509()
-        cert.set_serial_number(self.__next_serial)
-        cert.set_version(2)
-        cert.set_pubkey(key)
-        cert.gmtime_adj_notBefore(0)
-        cert.gmtime_adj_notAfter(365*24*60*60)
+        # keys missing from the pool are generated by the workers
+        keys = self.keypool.take(len(requests)) if self.keypool is not None else []
+        keys.extend([None] * (len(requests) - len(keys)))
 
-        cert_subject = cert.get_subject()
-        cert_subject.O = o
-        cert_subject.OU = 'kOVHernetes'
-        cert_subject.CN = cn
-        cert.set_issuer(self.cert.get_issuer())
+        if workers == 1 or len(requests) < 2:
+            return [_issue(self.cert, self.key, r, s, k, self.key_type) for r, s, k in zip(requests, serials, keys)]
 
-        cert_ext = []
-        cert_ext.append(crypto.X509Extension(b'subjectKeyIdentifier', False, b'hash', cert))
-        cert_ext.append(crypto.X509Extension(b'authorityKeyIdentifier', False, b'keyid,issuer', issuer=self.cert))
-        cert_ext.append(crypto.X509Extension(b'basicConstraints', False, b'CA:FALSE'))
-        cert_ext.append(crypto.X509Extension(b'keyUsage', True, b'nonRepudiation, digitalSignature, keyEncipherment'))
-        cert_ext.append(crypto.X509Extension(b'extendedKeyUsage', True, b'clientAuth'))
-        cert.add_extensions(cert_ext)
+        key_pems = [crypto.dump_privatekey(crypto.FILETYPE_PEM, k) if k is not None else None for k in keys]
 
-        # sign cert with CA key
-        cert.sign(self.key, 'sha256')
+        ca_crt_pem = crypto.dump_certificate(crypto.FILETYPE_PEM, self.cert)
+        ca_key_pem = crypto.dump_privatekey(crypto.FILETYPE_PEM, self.key)
 
-        type(self).__next_serial += 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_issue_pem, repeat(ca_crt_pem), repeat(ca_key_pem), requests, serials, key_pems,
+                                     repeat(self.key_type)))
 
-        return key, cert
+    def _reserve_serials(self, count):
+        """Reserve 'count' consecutive serial numbers, return the first one"""
 
-    def create_server_pair(self, o, cn, san=[]):
-        """Issue a X.509 server key/certificate pair"""
+        with _serial_lock:
+            first = CA.__next_serial
+            CA.__next_serial += count
 
-        # key
-        key = crypto.PKey()
-        key.generate_key(crypto.TYPE_RSA, 2048)
+        return first
 
-        # cert
-        cert = crypto.X509()
-        cert.set_serial_number(self.__next_serial)
-        cert.set_version(2)
-        cert.set_pubkey(key)
-        cert.gmtime_adj_notBefore(0)
-        cert.gmtime_adj_notAfter(365*24*60*60)
 
-        cert_subject = cert.get_subject()
-        cert_subject.O = o
-        cert_subject.OU = 'kOVHernetes'
-        cert_subject.CN = cn
-        cert.set_issuer(self.cert.get_issuer())
+def _new_key(key_type='rsa2048'):
+    """Generate a X.509 key of the given type"""
 
-        cert_ext = []
-        cert_ext.append(crypto.X509Extension(b'subjectKeyIdentifier', False, b'hash', cert))
-        cert_ext.append(crypto.X509Extension(b'authorityKeyIdentifier', False, b'keyid,issuer:always', issuer=self.cert))
+    if key_type == 'ecdsa-p256':
+        return crypto.PKey.from_cryptography_key(ec.generate_private_key(ec.SECP256R1(), default_backend()))
+
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    return key
+
+def _sign_cert(ca_cert, ca_key, key, serial, kind, o, cn, san=[]):
+    """Issue a X.509 client or server certificate signed by the given CA"""
+
+    cert = crypto.X509()
+    cert.set_serial_number(serial)
+    cert.set_version(2)
+    cert.set_pubkey(key)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(365*24*60*60)
+
+    cert_subject = cert.get_subject()
+    cert_subject.O = o
+    cert_subject.OU = 'kOVHernetes'
+    cert_subject.CN = cn
+    cert.set_issuer(ca_cert.get_issuer())
+
+    # key encipherment only applies to RSA keys
+    key_encipherment = b', keyEncipherment' if key.type() == crypto.TYPE_RSA else b''
+
+    cert_ext = []
+    cert_ext.append(crypto.X509Extension(b'subjectKeyIdentifier', False, b'hash', cert))
+    if kind == 'client':
+        cert_ext.append(crypto.X509Extension(b'authorityKeyIdentifier', False, b'keyid,issuer', issuer=ca_cert))
+        cert_ext.append(crypto.X509Extension(b'basicConstraints', False, b'CA:FALSE'))
+        cert_ext.append(crypto.X509Extension(b'keyUsage', True, b'nonRepudiation, digitalSignature' + key_encipherment))
+        cert_ext.append(crypto.X509Extension(b'extendedKeyUsage', True, b'clientAuth'))
+    elif kind == 'server':
+        cert_ext.append(crypto.X509Extension(b'authorityKeyIdentifier', False, b'keyid,issuer:always', issuer=ca_cert))
         cert_ext.append(crypto.X509Extension(b'basicConstraints', False, b'CA:FALSE'))
-        cert_ext.append(crypto.X509Extension(b'keyUsage', True, b'digitalSignature, keyEncipherment'))
+        cert_ext.append(crypto.X509Extension(b'keyUsage', True, b'digitalSignature' + key_encipherment))
         cert_ext.append(crypto.X509Extension(b'extendedKeyUsage', True, b'serverAuth'))
-        if san: cert_ext.append(crypto.X509Extension(b'subjectAltName', False, ','.join(san).encode()))
-        cert.add_extensions(cert_ext)
+        if san:
+            cert_ext.append(crypto.X509Extension(b'subjectAltName', False, ','.join(san).encode()))
+    else:
+        raise ValueError("certificate kind must be 'client' or 'server', not '{}'".format(kind))
+    cert.add_extensions(cert_ext)
 
-        # sign cert with CA key
-        cert.sign(self.key, 'sha256')
+    # sign cert with CA key
+    cert.sign(ca_key, 'sha256')
 
-        type(self).__next_serial += 1
+    return cert
 
-        return key, cert
+def _issue(ca_cert, ca_key, request, serial, key=None, key_type='rsa2048'):
+    """Sign all certificates of a request with a single key
+
+    A key of type 'key_type' is generated if not provided.
+    """
+    if key is None:
+        key = _new_key(key_type)
+
+    certs = OrderedDict()
+    for i, (name, kind, o, cn, san) in enumerate(request):
+        cert = _sign_cert(ca_cert, ca_key, key, serial + i, kind, o, cn, san)
+        certs[name] = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
+
+    return crypto.dump_privatekey(crypto.FILETYPE_PEM, key), certs
+
+def _issue_pem(ca_crt_pem, ca_key_pem, request, serial, key_pem=None, key_type='rsa2048'):
+    """Process pool entry point for _issue(), pyOpenSSL objects can't be pickled"""
+
+    ca_cert = crypto.load_certificate(crypto.FILETYPE_PEM, ca_crt_pem)
+    ca_key = crypto.load_privatekey(crypto.FILETYPE_PEM, ca_key_pem)
+    key = crypto.load_privatekey(crypto.FILETYPE_PEM, key_pem) if key_pem is not None else None
+
+    return _issue(ca_cert, ca_key, request, serial, key, key_type)
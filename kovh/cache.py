@@ -0,0 +1,162 @@
+from hashlib   import sha256
+from json      import dump, load
+from os        import makedirs, replace, listdir, remove
+from os.path   import join, getsize
+from tempfile  import NamedTemporaryFile
+from time      import monotonic, time
+from threading import Lock
+
+from .utils import cache_dir
+
+
+class Cache:
+    """In-memory key/value store with per-entry expiry
+
+    Keeps track of hits and misses so callers can verify how many lookups were
+    actually forwarded to the API.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return the value stored under key
+
+        Raises KeyError if the key is unknown or expired.
+        """
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                raise
+
+            if expires is not None and expires <= monotonic():
+                del self._entries[key]
+                self.misses += 1
+                raise KeyError(key)
+
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store value under key for ttl seconds (None for the default TTL)"""
+
+        if ttl is None:
+            ttl = self.ttl
+
+        with self._lock:
+            self._entries[key] = (monotonic() + ttl if ttl is not None else None, value)
+
+    def invalidate(self, prefix=None):
+        """Drop entries whose path starts with prefix, or all entries"""
+
+        with self._lock:
+            if prefix is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[0].startswith(prefix)]:
+                    del self._entries[key]
+
+
+class DiskCache:
+    """Persistent key/value store with per-entry expiry
+
+    Every entry is stored as a JSON document named after the hash of its key,
+    values must therefore be JSON-serializable.
+    """
+
+    def __init__(self, path=None, ttl=24*60*60, refresh=False):
+        if path is None:
+            path = cache_dir()
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        # ignore stored entries, but keep storing fresh ones
+        self.refresh = refresh
+
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return the value stored under key
+
+        Raises KeyError if the key is unknown or expired.
+        """
+        if self.refresh:
+            with self._lock:
+                self.misses += 1
+            raise KeyError(key)
+
+        try:
+            with open(self._file(key)) as f:
+                entry = load(f)
+        except (OSError, ValueError):
+            entry = None
+
+        with self._lock:
+            if entry is None or entry.get('key') != key or entry['expires'] <= time():
+                self.misses += 1
+                raise KeyError(key)
+
+            self.hits += 1
+            return entry['value']
+
+    def set(self, key, value, ttl=None):
+        """Store value under key for ttl seconds"""
+
+        if ttl is None:
+            ttl = self.ttl
+
+        makedirs(self.path, mode=0o700, exist_ok=True)
+
+        # write atomically, concurrent kovh processes may read the same entry
+        with NamedTemporaryFile('w', dir=self.path, delete=False) as f:
+            dump({'key': key, 'expires': time() + ttl, 'value': value}, f)
+        replace(f.name, self._file(key))
+
+    def stats(self):
+        """Return the number of entries, expired entries and their total size in bytes"""
+
+        entries = expired = size = 0
+        now = time()
+
+        for name in self._files():
+            try:
+                with open(join(self.path, name)) as f:
+                    if load(f)['expires'] <= now:
+                        expired += 1
+                size += getsize(join(self.path, name))
+            except (OSError, ValueError, KeyError):
+                continue
+            entries += 1
+
+        return entries, expired, size
+
+    def clear(self):
+        """Remove all entries, return how many were removed"""
+
+        removed = 0
+        for name in self._files():
+            try:
+                remove(join(self.path, name))
+            except OSError:
+                continue
+            removed += 1
+
+        return removed
+
+    def _files(self):
+        try:
+            return [n for n in listdir(self.path) if n.endswith('.json')]
+        except FileNotFoundError:
+            return []
+
+    def _file(self, key):
+        return join(self.path, sha256(key.encode()).hexdigest() + '.json')
@@ -1,12 +1,84 @@
-from ovh import Client as OVHClient
-from ovh.config import config
+from ovh              import Client as OVHClient, APIError
+from ovh.config       import config
+from requests.adapters import HTTPAdapter
+from threading        import Lock
+from time             import monotonic, sleep
+
+from .cache     import Cache, DiskCache
+from .scheduler import TokenBucket, Metrics, retry_delay, route
+from .trace     import tracer
+
+
+# maximum number of connections kept open to the API
+POOL_SIZE = 16
+
+# lifetime in seconds of the time delta between the local and API clocks
+TIME_DELTA_TTL = 60*60
+
+# maximum number of API requests per second, and attempts per request
+RATE_LIMIT = 20
+MAX_RETRIES = 5
 
 
 class Client(OVHClient):
 
-    def __init__(self, project=None, region=None, sshkey=None, flavor=None, **kwargs):
+    def __init__(self, project=None, region=None, sshkey=None, flavor=None, cache_ttl=None, refresh=False,
+                 **kwargs):
+        override_timeout = 'timeout' not in kwargs
+
         super().__init__(**kwargs)
 
+        # ovh>=1.0 loads config_file into a configuration of its own, the
+        # [kovhernetes] section is looked up in the global one
+        if kwargs.get('config_file') is not None:
+            config.read(kwargs['config_file'])
+
+        # per-request timeout in seconds, either 'total' or 'connect,read',
+        # read once the configuration file has been loaded
+        timeout = config.get('kovhernetes', 'timeout')
+        if timeout and override_timeout:
+            try:
+                timeout = tuple(float(t) for t in timeout.split(','))
+                if len(timeout) > 2 or min(timeout) <= 0:
+                    raise ValueError
+            except ValueError:
+                raise ValueError("Option 'timeout' expects 'total' or 'connect,read' seconds, got '{}'".format(
+                                 config.get('kovhernetes', 'timeout')))
+            self._timeout = timeout if len(timeout) > 1 else timeout[0]
+
+        # alternate API location, e.g. a local kovh.fakeapi server
+        api_url = config.get('kovhernetes', 'api_url')
+        if api_url:
+            self._endpoint = api_url.rstrip('/')
+
+        # size the connection pool for concurrent requests, connections are
+        # kept alive and reused unless disabled
+        pool_size = int(config.get('kovhernetes', 'pool_size') or POOL_SIZE)
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('https://', self._adapter)
+        self._session.mount('http://', self._adapter)
+
+        if (config.get('kovhernetes', 'keep_alive') or 'yes').lower() in ('no', 'false', '0', 'off'):
+            self._session.headers['Connection'] = 'close'
+
+        self._time_delta_lock = Lock()
+
+        # requests are throttled client-side and retried on transient errors
+        rate_limit = config.get('kovhernetes', 'rate_limit')
+        self.rate_limiter = TokenBucket(float(rate_limit) if rate_limit else RATE_LIMIT)
+        max_retries = config.get('kovhernetes', 'max_retries')
+        self.max_retries = int(max_retries) if max_retries else MAX_RETRIES
+        self.metrics = Metrics()
+
+        if cache_ttl is None:
+            cache_ttl = config.get('kovhernetes', 'cache_ttl')
+        cache_ttl = int(cache_ttl) if cache_ttl else 24*60*60
+
+        # request-scoped cache for read calls
+        self.cache = Cache()
+        # cache persisted across invocations for data which rarely changes
+        self.disk_cache = DiskCache(ttl=cache_ttl, refresh=refresh)
+
         if project is None:
             project = config.get('kovhernetes', 'project')
         self._project = project
@@ -23,6 +95,10 @@ class Client(OVHClient):
             flavor = config.get('kovhernetes', 'flavor')
         self._flavor = flavor
 
+        # object storage container holding cluster-wide assets
+        self._assets_url = config.get('kovhernetes', 'assets_url')
+        self._assets_token = config.get('kovhernetes', 'assets_token')
+
     def missing_params(self, params):
         config = {
             'project': self._project,
@@ -37,3 +113,101 @@ class Client(OVHClient):
                 empty.append(p)
 
         return set(empty).intersection(params)
+
+    def cached_get(self, _target, _ttl=None, _persist=False, **kwargs):
+        """GET wrapper memoizing responses for the lifetime of the client
+
+        With _persist, responses are also stored in the on-disk cache and
+        reused by subsequent invocations until _ttl expires.
+        Returned values are shared between callers and must not be modified.
+        """
+        key = (_target, tuple(sorted(kwargs.items())))
+
+        try:
+            return self.cache.get(key)
+        except KeyError:
+            pass
+
+        if _persist:
+            disk_key = ' '.join([self._endpoint, _target] + ['{}={}'.format(k, v) for k, v in key[1]])
+            try:
+                value = self.disk_cache.get(disk_key)
+            except KeyError:
+                value = self.get(_target, **kwargs)
+                self.disk_cache.set(disk_key, value, _ttl)
+        else:
+            value = self.get(_target, **kwargs)
+
+        self.cache.set(key, value, _ttl)
+
+        return value
+
+    def call(self, method, path, data=None, need_auth=True):
+        """Send an API request, retrying on throttling and transient errors
+
+        Throttled requests are retried regardless of their method, other
+        transient errors only for idempotent methods.
+        """
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+
+            start = monotonic()
+            with tracer.span('{} {}'.format(method, route(path)), 'api', path=path, attempt=attempt) as span:
+                try:
+                    result = super().call(method, path, data, need_auth)
+                except APIError as e:
+                    error = e
+                    response = getattr(e, 'response', None)
+                    span['status'] = response.status_code if response is not None else 'network error'
+                else:
+                    error = None
+                    span['status'] = 'OK'
+
+            if error is None:
+                self.metrics.record(method, path, monotonic() - start)
+                return result
+
+            delay = retry_delay(method, error, attempt) if attempt < self.max_retries else None
+            self.metrics.record(method, path, monotonic() - start, retried=delay is not None, failed=delay is None)
+            if delay is None:
+                raise error
+            sleep(delay)
+            attempt += 1
+
+    @property
+    def time_delta(self):
+        """Time delta between the local and API clocks, used to sign requests
+
+        Fetched once by concurrent callers, and persisted in the disk cache
+        so that subsequent invocations don't need to query it.
+        """
+        if self._time_delta is None:
+            with self._time_delta_lock:
+                if self._time_delta is None:
+                    key = self._endpoint + ' time_delta'
+                    try:
+                        self._time_delta = self.disk_cache.get(key)
+                    except KeyError:
+                        self._time_delta = super().time_delta
+                        self.disk_cache.set(key, self._time_delta, TIME_DELTA_TTL)
+
+        return self._time_delta
+
+    def connection_stats(self):
+        """Return the number of connections opened and requests sent through them"""
+
+        connections = requests = 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests += pool.num_requests
+
+        return connections, requests
+
+    def invalidate(self, prefix=None):
+        """Drop cached responses for paths starting with prefix, or all of them"""
+
+        self.cache.invalidate(prefix)
@@ -0,0 +1,320 @@
+"""Local stand-in for the OVH Cloud API
+
+Serves the subset of the API used by kovh from in-memory state, so that
+commands can be exercised and measured without creating real resources.
+Request signatures are not verified.
+
+Usage:
+  kovh.fakeapi [options]
+
+Options:
+  -p, --port PORT         Port to listen on [default: 8080]
+  -l, --latency SECS      Delay added to every response [default: 0]
+  -e, --error-rate RATE   Fraction of requests failing with HTTP 503 [default: 0]
+  -r, --rate-limit NUM    Requests accepted per second before answering HTTP 429, 0 for no limit [default: 0]
+  -b, --build-time SECS   Time before instances and networks become ACTIVE [default: 0]
+  -d, --delete-time SECS  Time before deleted instances vanish [default: 0]
+  -h, --help              Show this screen
+
+Run it with 'python -m kovh.fakeapi', then point kovh at it by setting
+'api_url' in the [kovhernetes] configuration section, e.g.
+'api_url=http://127.0.0.1:8080/1.0'. Objects stored under /storage/ can
+serve as a container for 'assets_url'.
+"""
+
+from http.server  import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ipaddress    import IPv4Address
+from itertools    import count
+from json         import dumps, loads
+from random       import random, uniform
+from re           import fullmatch
+from threading    import Lock, Thread
+from time         import monotonic, sleep, time
+from urllib.parse import urlsplit, parse_qs
+from uuid         import uuid4
+
+
+PROJECT = 'fakeproject'
+REGIONS = {'GRA1': 'EU', 'SBG1': 'EU', 'BHS1': 'NA'}
+FLAVORS = [('b2-7', 2, 7000, 50), ('b2-15', 4, 15000, 100), ('b2-30', 8, 30000, 200)]
+IMAGES = ['Container Linux CoreOS', 'Debian 9', 'Ubuntu 16.04']
+
+
+class FakeAPI:
+    """In-memory state of the fake API
+
+    Arguments:
+    latency -- delay in seconds added to every response, with 50% jitter
+    error_rate -- fraction of requests failing with HTTP 503
+    rate_limit -- requests accepted per second before answering HTTP 429, 0 for no limit
+    build_time -- time in seconds before instances and networks become ACTIVE
+    delete_time -- time in seconds before deleted instances vanish
+
+    Statuses are derived from timestamps when resources are read, no
+    background thread is involved.
+    """
+
+    def __init__(self, latency=0, error_rate=0, rate_limit=0, build_time=0, delete_time=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.build_time = build_time
+        self.delete_time = delete_time
+
+        self.requests = 0
+        self.instances = {}
+        self.networks = {}
+        self.subnets = {}
+        self.objects = {}
+
+        self._public_ips = count(int(IPv4Address('198.51.100.10')))
+        self._window = (0, 0)
+        self._lock = Lock()
+
+        self.routes = [
+            ('GET', r'/auth/time', lambda m, q, b: int(time())),
+            ('GET', r'/cloud/project', lambda m, q, b: [PROJECT]),
+            ('GET', r'/cloud/project/(\w+)', lambda m, q, b: {'project_id': m[1], 'description': 'fake project'}),
+            ('GET', r'/cloud/project/\w+/region', lambda m, q, b: sorted(REGIONS)),
+            ('GET', r'/cloud/project/\w+/region/(\w+)', self.get_region),
+            ('GET', r'/cloud/project/\w+/flavor', self.get_flavors),
+            ('GET', r'/cloud/project/\w+/image', self.get_images),
+            ('GET', r'/cloud/project/\w+/snapshot', lambda m, q, b: []),
+            ('GET', r'/cloud/project/\w+/sshkey', lambda m, q, b: [{'id': 'fakekey', 'name': 'fake'}]),
+            ('GET', r'/cloud/project/\w+/usage/current', lambda m, q, b: {'hourlyUsage': None}),
+            ('GET', r'/cloud/project/\w+/network/public', lambda m, q, b: [{'id': 'Ext-Net', 'name': 'Ext-Net'}]),
+            ('GET', r'/cloud/project/\w+/network/private', lambda m, q, b: [self.network(n) for n in self.networks]),
+            ('POST', r'/cloud/project/\w+/network/private', self.create_network),
+            ('GET', r'/cloud/project/\w+/network/private/([\w-]+)', lambda m, q, b: self.network(m[1])),
+            ('DELETE', r'/cloud/project/\w+/network/private/([\w-]+)', self.delete_network),
+            ('GET', r'/cloud/project/\w+/network/private/([\w-]+)/subnet', self.get_subnets),
+            ('POST', r'/cloud/project/\w+/network/private/([\w-]+)/subnet', self.create_subnet),
+            ('GET', r'/cloud/project/\w+/instance', self.list_instances),
+            ('POST', r'/cloud/project/\w+/instance', self.create_instance),
+            ('GET', r'/cloud/project/\w+/instance/([\w-]+)', self.get_instance),
+            ('DELETE', r'/cloud/project/\w+/instance/([\w-]+)', self.delete_instance)
+        ]
+
+    def handle(self, method, path, query, body):
+        """Route a request, return a (status, headers, payload) tuple"""
+
+        with self._lock:
+            self.requests += 1
+
+            if self.rate_limit:
+                second = int(monotonic())
+                window, used = self._window
+                used = used + 1 if window == second else 1
+                self._window = (second, used)
+                if used > self.rate_limit:
+                    return 429, {'Retry-After': '1'}, {'message': 'Too many requests'}
+
+        if self.latency:
+            sleep(uniform(self.latency / 2, self.latency * 1.5))
+
+        if self.error_rate and random() < self.error_rate:
+            return 503, {}, {'message': 'Injected error'}
+
+        for m, pattern, handler in self.routes:
+            match = fullmatch(pattern, path)
+            if match and m == method:
+                try:
+                    with self._lock:
+                        return 200, {}, handler(match, query, body)
+                except _APIError as e:
+                    return e.status, {}, {'message': e.message}
+
+        return 404, {}, {'message': 'The requested object ({} {}) does not exist'.format(method, path)}
+
+    def not_found(self):
+        raise _APIError(404, 'The requested object does not exist')
+
+    # handlers receive the path match, query parameters and request body
+
+    def get_region(self, m, query, body):
+        if m[1] not in REGIONS:
+            self.not_found()
+        return {'name': m[1], 'continentCode': REGIONS[m[1]], 'status': 'UP'}
+
+    def get_flavors(self, m, query, body):
+        regions = query.get('region', sorted(REGIONS))
+        return [{'id': '{}-{}'.format(name, r), 'name': name, 'vcpus': vcpus, 'ram': ram, 'disk': disk,
+                 'type': 'ovh.ssd.eg', 'region': r} for r in regions for name, vcpus, ram, disk in FLAVORS]
+
+    def get_images(self, m, query, body):
+        regions = query.get('region', sorted(REGIONS))
+        return [{'id': 'image-{}-{}'.format(i, r), 'name': name, 'user': name.split()[0].lower(), 'region': r,
+                 'type': 'linux'} for r in regions for i, name in enumerate(IMAGES)]
+
+    def network(self, net_id):
+        net = self.networks.get(net_id) or self.not_found()
+        status = 'ACTIVE' if time() >= net['created'] + self.build_time else 'BUILDING'
+        return {'id': net['id'], 'name': net['name'], 'vlanId': net['vlanId'], 'status': status,
+                'regions': [{'region': r, 'status': status} for r in net['regions']]}
+
+    def create_network(self, m, query, body):
+        vlan = body.get('vlanId')
+        if any(n['vlanId'] == vlan for n in self.networks.values()):
+            raise _APIError(409, 'vlanId {} is already used by another private network'.format(vlan))
+
+        net_id = 'pn-{}_{}'.format(uuid4().hex[:6], vlan)
+        self.networks[net_id] = {'id': net_id, 'name': body.get('name'), 'vlanId': vlan,
+                                 'regions': body.get('regions') or [], 'created': time()}
+        return self.network(net_id)
+
+    def delete_network(self, m, query, body):
+        self.network(m[1])
+        if any(n.get('networkId') == m[1] for i in self.instances.values() for n in i['networks']):
+            raise _APIError(400, 'Private network still has instances attached')
+        del self.networks[m[1]]
+        self.subnets.pop(m[1], None)
+
+    def get_subnets(self, m, query, body):
+        self.network(m[1])
+        return self.subnets.get(m[1], [])
+
+    def create_subnet(self, m, query, body):
+        self.network(m[1])
+        subnet = {'id': str(uuid4()), 'cidr': body.get('network'), 'ipPools': [
+            {'start': body.get('start'), 'end': body.get('end'), 'dhcp': body.get('dhcp'),
+             'region': body.get('region'), 'network': body.get('network')}
+        ]}
+        self.subnets.setdefault(m[1], []).append(subnet)
+        return subnet
+
+    def instance(self, inst_id):
+        inst = self.instances.get(inst_id)
+        if inst is None:
+            return None
+
+        now = time()
+        if inst['deleted'] is not None:
+            if now >= inst['deleted'] + self.delete_time:
+                del self.instances[inst_id]
+                return None
+            status = 'DELETING'
+        else:
+            status = 'ACTIVE' if now >= inst['created'] + self.build_time else 'BUILD'
+
+        return {'id': inst['id'], 'name': inst['name'], 'status': status, 'region': inst['region'],
+                'flavorId': inst['flavorId'], 'imageId': inst['imageId'], 'ipAddresses': inst['ipAddresses']}
+
+    def list_instances(self, m, query, body):
+        return [i for i in map(self.instance, list(self.instances)) if i is not None]
+
+    def get_instance(self, m, query, body):
+        return self.instance(m[1]) or self.not_found()
+
+    def create_instance(self, m, query, body):
+        for field in ('name', 'flavorId', 'imageId', 'region'):
+            if not body.get(field):
+                raise _APIError(400, "Missing parameter '{}'".format(field))
+
+        inst_id = str(uuid4())
+        ip_addresses = [{'ip': str(IPv4Address(next(self._public_ips))), 'version': 4, 'type': 'public'}]
+        for n in body.get('networks') or []:
+            if n.get('networkId') in self.networks and n.get('ip'):
+                ip_addresses.append({'ip': n['ip'], 'version': 4, 'type': 'private'})
+
+        self.instances[inst_id] = {'id': inst_id, 'name': body['name'], 'region': body['region'],
+                                   'flavorId': body['flavorId'], 'imageId': body['imageId'],
+                                   'networks': body.get('networks') or [], 'ipAddresses': ip_addresses,
+                                   'userData': body.get('userData'), 'created': time(), 'deleted': None}
+        return self.instance(inst_id)
+
+    def delete_instance(self, m, query, body):
+        if self.instance(m[1]) is None:
+            self.not_found()
+        if self.instances[m[1]]['deleted'] is None:
+            self.instances[m[1]]['deleted'] = time()
+        self.instance(m[1])
+
+
+class _APIError(Exception):
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Translate HTTP requests into FakeAPI calls"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_request(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else b''
+
+        if url.path.startswith('/storage/'):
+            return self.storage(url.path, data)
+
+        path = url.path[len('/1.0'):] if url.path.startswith('/1.0/') else url.path
+        query = parse_qs(url.query)
+        body = loads(data) if data else {}
+
+        status, headers, payload = self.server.api.handle(self.command, path, query, body)
+        self.reply(status, headers, dumps(payload).encode())
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_request
+
+    def do_HEAD(self):
+        path = urlsplit(self.path).path
+        self.reply(200 if path in self.server.api.objects else 404, {}, b'', head=True)
+
+    def storage(self, path, data):
+        """Minimal object storage, e.g. for asset stores"""
+
+        objects = self.server.api.objects
+        if self.command == 'PUT':
+            objects[path] = data
+            self.reply(201, {}, b'')
+        elif self.command == 'GET' and path in objects:
+            self.reply(200, {}, objects[path])
+        else:
+            self.reply(404, {}, b'')
+
+    def reply(self, status, headers, body, head=False):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(api, host='127.0.0.1', port=0):
+    """Serve a FakeAPI from a background thread
+
+    Returns the server, its URL is 'http://<host>:<server.server_port>/1.0'.
+    Stop it with server.shutdown().
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.api = api
+
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+
+    args = docopt(__doc__)
+
+    api = FakeAPI(float(args['--latency']), float(args['--error-rate']), int(args['--rate-limit']),
+                  float(args['--build-time']), float(args['--delete-time']))
+    server = serve(api, port=int(args['--port']))
+
+    print('Fake OVH API listening on http://127.0.0.1:{}/1.0 (project {})'.format(server.server_port, PROJECT))
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,98 +1,118 @@
+from base64         import b64encode
 from json           import dumps
 from OpenSSL.crypto import dump_certificate, dump_privatekey, FILETYPE_PEM
-from urllib.parse   import quote
 
 from .project  import get_coreos_images
-from .userdata import UserData
+from .userdata import UserData, encode_contents
+
+
+# maximum size of the base64-encoded User Data accepted by the OVH API
+USERDATA_MAX_SIZE = 65535
 
 
 class Host:
 
-    def __init__(self, name, roles, pub_net, priv_net, client, ca, ip):
+    def __init__(self, name, roles, pub_net, priv_net, client, ca, ip, cluster_ips, pki=None, fragments=None,
+                 image=None):
         self.name = name
         self.roles = roles
-        self.flavor = client._flavor
-        self.sshkey = client._sshkey
-        self.region = client._region
+        # no client when rendering offline, the image must then be provided
+        self.flavor = client._flavor if client is not None else None
+        self.sshkey = client._sshkey if client is not None else None
+        self.region = client._region if client is not None else None
         self.pub_net = pub_net
         self.priv_net = priv_net
         self.ip = ip
 
-        self.image = get_coreos_images(client)[0]
+        # looked up from the API unless provided
+        self.image = image if image is not None else get_coreos_images(client)[0]
 
-        self.userdata = UserData()
+        self.userdata = UserData(fragments=fragments)
         self.userdata.configure_clinux_core()
-        self.userdata.gen_etc_hosts(client, priv_net)
+        self.userdata.gen_etc_hosts(cluster_ips)
+
+        # issue PKI material inline unless it was provided by CA.issue_batch()
+        if pki is None:
+            pki = ca.issue(self.pki_request(roles, ip))
+        key_pem, crts_pem = pki
 
         if any([r in self.roles for r in ['master', 'node']]):
             self.userdata.gen_kube_data(self.roles)
 
-            # Dump X.509 CA cert
-            ca_crt_pem = dump_certificate(FILETYPE_PEM, ca.cert)
-
-            # we generate a single RSA key per host due to User Data size limit of 65535 bytes (base64-encoded)
-            key = ca.create_key()
-            key_pem = dump_privatekey(FILETYPE_PEM, key)
-
-            # TLS client certificates
-            kubelet_client_crt = ca.create_client_cert(key, 'system:nodes', 'system:node:host-' + ip.replace('.', '-'))
-            kubelet_client_crt_pem = dump_certificate(FILETYPE_PEM, kubelet_client_crt)
-            proxy_client_crt = ca.create_client_cert(key, 'Kubernetes', 'system:kube-proxy')
-            proxy_client_crt_pem = dump_certificate(FILETYPE_PEM, proxy_client_crt)
-
-            # TLS server certificates
-            kubelet_server_crt = ca.create_server_cert(key, 'Kubernetes', 'host-' + ip.replace('.', '-'))
-            kubelet_server_crt_pem = dump_certificate(FILETYPE_PEM, kubelet_server_crt)
-
             self.userdata.add_files ([
                 {
                     'filesystem': 'root',
                     'path': '/etc/kubernetes/tls/host.key',
                     'mode': 416, # 0640
-                    'contents': {
-                        'source': 'data:,' + quote(key_pem)
-                    }
-                },
-                {
-                    'filesystem': 'root',
-                    'path': '/etc/kubernetes/tls/ca.pem',
-                    'mode': 420, # 0644
-                    'contents': {
-                        'source': 'data:,' + quote(ca_crt_pem)
-                    }
-                },
-                {
-                    'filesystem': 'root',
-                    'path': '/etc/kubernetes/tls/client/kubelet.crt',
-                    'mode': 420, # 0644
-                    'contents': {
-                        'source': 'data:,' + quote(kubelet_client_crt_pem)
-                    }
-                },
-                {
-                    'filesystem': 'root',
-                    'path': '/etc/kubernetes/tls/server/kubelet.crt',
-                    'mode': 420, # 0644
-                    'contents': {
-                        'source': 'data:,' + quote(kubelet_server_crt_pem)
-                    }
-                },
-                {
-                    'filesystem': 'root',
-                    'path': '/etc/kubernetes/tls/client/proxy.crt',
-                    'mode': 420, # 0644
-                    'contents': {
-                        'source': 'data:,' + quote(proxy_client_crt_pem)
-                    }
+                    'contents': encode_contents(key_pem)
                 }
             ])
 
+            def render_ca_crt():
+                # Dump X.509 CA cert
+                ca_crt_pem = dump_certificate(FILETYPE_PEM, ca.cert)
+
+                return [
+                    {
+                        'filesystem': 'root',
+                        'path': '/etc/kubernetes/tls/ca.pem',
+                        'mode': 420, # 0644
+                        'contents': self.userdata.fragments.encode(ca_crt_pem)
+                    }
+                ]
+
+            self.userdata.add_files(self.userdata.fragments.get('ca-crt', render_ca_crt))
+
         if 'master' in self.roles:
             self.userdata.gen_kubemaster_data()
 
-            # Dump X.509 CA key
-            ca_key_pem = dump_privatekey(FILETYPE_PEM, ca.key)
+            def render_ca_key():
+                # Dump X.509 CA key
+                ca_key_pem = dump_privatekey(FILETYPE_PEM, ca.key)
 
+                return [
+                    {
+                        'filesystem': 'root',
+                        'path': '/etc/kubernetes/tls/ca.key',
+                        'mode': 416, # 0640
+                        'contents': encode_contents(ca_key_pem)
+                    }
+                ]
+
+            self.userdata.add_files(self.userdata.fragments.get('ca-key', render_ca_key))
+
+        # TLS certificates
+        self.userdata.add_files ([
+            {
+                'filesystem': 'root',
+                'path': '/etc/kubernetes/tls/' + path,
+                'mode': 420, # 0644
+                'contents': encode_contents(crt_pem)
+            } for path, crt_pem in crts_pem.items()
+        ])
+
+    @staticmethod
+    def pki_request(roles, ip):
+        """Describe the certificates required by a host with the given roles
+
+        Returns a list of (path, kind, o, cn, san) tuples suitable for
+        CA.issue() and CA.issue_batch(), where path is relative to the TLS
+        directory of the host.
+        """
+        hostname = 'host-' + ip.replace('.', '-')
+        request = []
+
+        # we generate a single key per host due to User Data size limit of 65535 bytes (base64-encoded)
+        if any([r in roles for r in ['master', 'node']]):
+            request.extend([
+                # TLS client certificates
+                ('client/kubelet.crt', 'client', 'system:nodes', 'system:node:' + hostname, []),
+                ('client/proxy.crt', 'client', 'Kubernetes', 'system:kube-proxy', []),
+                # TLS server certificates
+                ('server/kubelet.crt', 'server', 'Kubernetes', hostname, [])
+            ])
+
+        if 'master' in roles:
             # TLS server pair for kube API server
             apiserver_san = [
                 'DNS:kubernetes.default.svc.cluster.local',
@@ -102,91 +122,31 @@ class Host:
                 'IP:10.0.0.1',
                 'DNS:localhost',
                 'IP:127.0.0.1',
-                'DNS:' + 'host-' + ip.replace('.', '-'),
+                'DNS:' + hostname,
                 'IP:' + ip
             ]
-            apiserver_crt = ca.create_server_cert(key, 'Kubernetes', 'apiserver', apiserver_san)
-            apiserver_crt_pem = dump_certificate(FILETYPE_PEM, apiserver_crt)
 
             # TLS server pair for etcd member
             etcd_san = [
                 'DNS:localhost',
                 'IP:127.0.0.1',
-                'DNS:' + 'host-' + ip.replace('.', '-'),
+                'DNS:' + hostname,
                 'IP:' + ip
             ]
-            etcd_member_crt = ca.create_server_cert(key, 'etcd', 'member', etcd_san)
-            etcd_member_crt_pem = dump_certificate(FILETYPE_PEM, etcd_member_crt)
-
-            # TLS client certificates
-            cm_crt = ca.create_client_cert(key, 'Kubernetes', 'system:kube-controller-manager')
-            cm_crt_pem = dump_certificate(FILETYPE_PEM, cm_crt)
-            scheduler_crt = ca.create_client_cert(key, 'Kubernetes', 'system:kube-scheduler')
-            scheduler_crt_pem = dump_certificate(FILETYPE_PEM, scheduler_crt)
-            apiserver_client_crt = ca.create_client_cert(key, 'system:masters', 'apiserver:host-' + ip.replace('.', '-'))
-            apiserver_client_crt_pem = dump_certificate(FILETYPE_PEM, apiserver_client_crt)
-            etcd_client_crt = ca.create_client_cert(key, 'etcd', 'root')
-            etcd_client_crt_pem = dump_certificate(FILETYPE_PEM, etcd_client_crt)
 
-            self.userdata.add_files ([
-                {
-                    'filesystem': 'root',
-                    'path': '/etc/kubernetes/tls/ca.key',
-                    'mode': 416, # 0640
-                    'contents': {
-                        'source': 'data:,' + quote(ca_key_pem)
-                    }
-                },
-                {
-                    'filesystem': 'root',
-                    'path': '/etc/kubernetes/tls/server/apiserver.crt',
-                    'mode': 420, # 0644
-                    'contents': {
-                        'source': 'data:,' + quote(apiserver_crt_pem)
-                    }
-                },
-                {
-                    'filesystem': 'root',
-                    'path': '/etc/kubernetes/tls/server/etcd.crt',
-                    'mode': 420, # 0644
-                    'contents': {
-                        'source': 'data:,' + quote(etcd_member_crt_pem)
-                    }
-                },
-                {
-                    'filesystem': 'root',
-                    'path': '/etc/kubernetes/tls/client/controller-manager.crt',
-                    'mode': 420, # 0644
-                    'contents': {
-                        'source': 'data:,' + quote(cm_crt_pem)
-                    }
-                },
-                {
-                    'filesystem': 'root',
-                    'path': '/etc/kubernetes/tls/client/scheduler.crt',
-                    'mode': 420, # 0644
-                    'contents': {
-                        'source': 'data:,' + quote(scheduler_crt_pem)
-                    }
-                },
-                {
-                    'filesystem': 'root',
-                    'path': '/etc/kubernetes/tls/client/apiserver.crt',
-                    'mode': 420, # 0644
-                    'contents': {
-                        'source': 'data:,' + quote(apiserver_client_crt_pem)
-                    }
-                },
-                {
-                    'filesystem': 'root',
-                    'path': '/etc/kubernetes/tls/client/etcd.crt',
-                    'mode': 420, # 0644
-                    'contents': {
-                        'source': 'data:,' + quote(etcd_client_crt_pem)
-                    }
-                }
+            request.extend([
+                # TLS server certificates
+                ('server/apiserver.crt', 'server', 'Kubernetes', 'apiserver', apiserver_san),
+                ('server/etcd.crt', 'server', 'etcd', 'member', etcd_san),
+                # TLS client certificates
+                ('client/controller-manager.crt', 'client', 'Kubernetes', 'system:kube-controller-manager', []),
+                ('client/scheduler.crt', 'client', 'Kubernetes', 'system:kube-scheduler', []),
+                ('client/apiserver.crt', 'client', 'system:masters', 'apiserver:' + hostname, []),
+                ('client/etcd.crt', 'client', 'etcd', 'root', [])
             ])
 
+        return request
+
     def make_body(self):
         body = {
             'name': self.name,
@@ -209,3 +169,81 @@ class Host:
             'userData': dumps(self.userdata.data, separators=(',', ':'))
         }
         return body
+
+    def userdata_size(self):
+        """Return the size of the User Data once base64-encoded by the API"""
+
+        return len(b64encode(dumps(self.userdata.data, separators=(',', ':')).encode()))
+
+    def userdata_fits(self):
+        """Return whether the User Data fits within the size limit of the API"""
+
+        return self.userdata_size() <= USERDATA_MAX_SIZE
+
+
+def make_cluster(longname, ips, pub_net, client, ca, pki, fragments=None, image=None):
+    """Generate the master and nodes of a cluster
+
+    Arguments:
+    longname -- cluster name prefix, e.g. 'kovh:<name>:'
+    ips -- private IP addresses of all hosts, starting with the master
+    pki -- PKI material of all hosts as returned by CA.issue_batch(), in the same order
+    fragments -- Fragments shared by all hosts of the cluster
+    image -- image ID, looked up from the API if not provided
+
+    Private networks are left unset. Returns a (master, [nodes]) tuple.
+    """
+    master = make_master(longname, ips[0], ips, pub_net, client, ca, pki[0], fragments, image)
+    nodes = [make_node(longname, i, ips[i], ips, pub_net, client, ca, pki[i], fragments, image)
+             for i in range(1, len(ips))]
+
+    return master, nodes
+
+def make_master(longname, ip, cluster_ips, pub_net, client, ca, pki, fragments=None, image=None):
+    """Generate the master of a cluster
+
+    Arguments are those of make_cluster(), except for the private IP address
+    'ip' of the master and its PKI material 'pki'.
+    """
+    master = Host(
+        name='{}:master'.format(longname),
+        roles=['master', 'node'],
+        pub_net=pub_net,
+        priv_net=None,
+        client=client,
+        ca=ca,
+        ip=ip,
+        cluster_ips=cluster_ips,
+        pki=pki,
+        fragments=fragments,
+        image=image
+    )
+    for c in ('kubelet', 'proxy', 'controller-manager', 'scheduler'):
+        master.userdata.gen_kubeconfig(c)
+
+    return master
+
+def make_node(longname, number, ip, cluster_ips, pub_net, client, ca, pki, fragments=None, image=None):
+    """Generate the node 'number' of a cluster
+
+    Arguments are those of make_cluster(), except for the private IP address
+    'ip' of the node and its PKI material 'pki'. The master is expected to
+    hold the first address of 'cluster_ips'.
+    """
+    node = Host(
+        name='{}:node{:02}'.format(longname, number),
+        roles=['node'],
+        pub_net=pub_net,
+        priv_net=None,
+        client=client,
+        ca=ca,
+        ip=ip,
+        cluster_ips=cluster_ips,
+        pki=pki,
+        fragments=fragments,
+        image=image
+    )
+    for c in ('kubelet', 'proxy'):
+        node.userdata.gen_kubeconfig(c, 'host-' + cluster_ips[0].replace('.', '-'))
+
+    return node
@@ -0,0 +1,88 @@
+from json         import dump, load
+from os           import makedirs, remove, replace
+from os.path      import join
+from tempfile     import NamedTemporaryFile
+from urllib.parse import quote
+
+from .utils import data_dir
+
+
+class ClusterIndex:
+    """Local record of the resources created for every cluster
+
+    Lets commands resolve the members of a cluster by id instead of listing
+    all resources of the project. Every cluster is recorded as a JSON document
+    holding the ids of its 'instances' and 'networks', and whether its
+    creation went 'complete'. Incomplete records can't be trusted to list all
+    members of a cluster, they hold the 'state' of the interrupted creation
+    instead, for it to be resumed. The CA of a cluster is recorded next to
+    it, so that hosts added later are issued certificates trusted by the
+    existing ones.
+
+    Arguments:
+    project -- project the clusters belong to
+    path -- directory holding the records, defaults to the data directory
+    """
+
+    def __init__(self, project, path=None):
+        if path is None:
+            path = join(data_dir(), 'clusters')
+        self.path = join(path, project)
+
+    def get(self, name):
+        """Return the record of a cluster, or None if it is unknown"""
+
+        try:
+            with open(self._file(name)) as f:
+                return load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, name, instances, networks, complete=True, state=None):
+        """Record the ids of the resources of a cluster
+
+        'state' is a dict describing the progress of an incomplete creation.
+        """
+        record = {
+            'instances': list(instances),
+            'networks': list(networks),
+            'complete': complete,
+            'state': state
+        }
+
+        self._write(self._file(name), record)
+
+    def get_ca(self, name):
+        """Return the CA of a cluster as serialized by CA.dump(), or None if it is unknown"""
+
+        try:
+            with open(self._file(name, '.ca')) as f:
+                return load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set_ca(self, name, ca):
+        """Record the CA of a cluster, as serialized by CA.dump()"""
+
+        self._write(self._file(name, '.ca'), ca)
+
+    def remove(self, name):
+        """Forget a cluster and its CA"""
+
+        for suffix in ('.json', '.ca'):
+            try:
+                remove(self._file(name, suffix))
+            except FileNotFoundError:
+                pass
+
+    def _write(self, path, data):
+        makedirs(self.path, mode=0o700, exist_ok=True)
+
+        # write atomically, a crash must not leave a truncated record behind,
+        # temporary files are only readable by their owner
+        with NamedTemporaryFile('w', dir=self.path, delete=False) as f:
+            dump(data, f)
+        replace(f.name, path)
+
+    def _file(self, name, suffix='.json'):
+        return join(self.path, quote(name, safe='') + suffix)
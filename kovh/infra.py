@@ -1,4 +1,59 @@
-from ovh import APIError, ResourceNotFoundError
+from ovh                import APIError, ResourceNotFoundError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ipaddress          import IPv4Address, IPv4Network
+
+
+# highest VLAN id accepted by the vRack
+MAX_VLAN = 4000
+
+# networks used inside the cluster, the private network must not overlap them
+POD_NETWORK = IPv4Network('172.17.0.0/16')
+SERVICE_NETWORK = IPv4Network('10.0.0.0/16')
+
+
+class IPAllocator:
+    """Hand out consecutive host addresses of a subnet
+
+    Addresses are computed from the subnet boundaries instead of enumerating
+    all hosts of the subnet, allocations therefore don't depend on its size.
+
+    Arguments:
+    subnet -- IPv4Network to allocate addresses from
+    reserved -- position of the first host address handed out, e.g. 10 for
+                the 10th host address, earlier ones are never handed out
+    taken -- addresses already in use, skipped when allocating
+    """
+
+    def __init__(self, subnet, reserved=10, taken=()):
+        self.subnet = subnet
+        self.assigned = []
+
+        self._next = int(subnet.network_address) + reserved
+        self._last = int(subnet.broadcast_address) - 1
+        self._taken = {int(IPv4Address(ip)) for ip in taken}
+
+    def __len__(self):
+        """Number of addresses left"""
+
+        taken = sum(1 for ip in self._taken if self._next <= ip <= self._last)
+        return max(0, self._last - self._next + 1 - taken)
+
+    def allocate(self, count=1):
+        """Return the next 'count' free addresses as strings
+
+        Raises ValueError if the subnet doesn't have enough addresses left.
+        """
+        if count > len(self):
+            raise ValueError('subnet {} has {} addresses left, {} requested'.format(self.subnet, len(self), count))
+
+        ips = []
+        while len(ips) < count:
+            if self._next not in self._taken:
+                ips.append(str(IPv4Address(self._next)))
+            self._next += 1
+        self.assigned.extend(ips)
+
+        return ips
 
 
 def create_priv_network(client, name, vlan):
@@ -15,17 +70,25 @@ def create_priv_network(client, name, vlan):
     else:
         return net
 
-def create_subnet(client, net_id, subnet):
-    hosts = tuple(subnet.hosts())
+def network_active(client, net_id):
+    """Return whether a private network reached the ACTIVE status"""
 
+    try:
+        net = client.get('/cloud/project/{}/network/private/{}'.format(client._project, net_id))
+    except ResourceNotFoundError:
+        return False
+
+    return net.get('status') == 'ACTIVE'
+
+def create_subnet(client, net_id, subnet):
     params = {
         'networkId': net_id,
         'dhcp': True,
         'noGateway': True,
         'region': client._region,
         'network': str(subnet),
-        'start': str(hosts[0]),
-        'end': str(hosts[-1])
+        'start': str(subnet.network_address + 1),
+        'end': str(subnet.broadcast_address - 1)
     }
 
     try:
@@ -33,21 +96,166 @@ def create_subnet(client, net_id, subnet):
     except APIError:
         raise
     else:
+        client.invalidate('/cloud/project/{}/network/private/{}/subnet'.format(client._project, net_id))
         return subnet
 
-def next_vlan(client):
+def get_subnet(client, net_id):
+    """Return the address range of the first subnet of a private network as an IPv4Network
+
+    Raises ValueError if the network has no subnet.
+    """
+    try:
+        subnets = client.get('/cloud/project/{}/network/private/{}/subnet'.format(client._project, net_id))
+    except APIError:
+        raise
+    else:
+        if not subnets:
+            raise ValueError("Private network '{}' has no subnet".format(net_id))
+        return IPv4Network(subnets[0]['cidr'])
+
+def create_instance(client, body):
+    try:
+        inst = client.post('/cloud/project/{}/instance'.format(client._project), **body)
+    except APIError:
+        raise
+    else:
+        return inst
+
+def create_instances(client, hosts, parallelism=1):
+    """Submit instance creations concurrently
+
+    Yields a (host, instance, error) tuple for every host as soon as its
+    request completes, instead of raising on the first APIError.
+    """
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        futures = {executor.submit(create_instance, client, h.make_body()): h for h in hosts}
+
+        for f in as_completed(futures):
+            try:
+                yield futures[f], f.result(), None
+            except APIError as e:
+                yield futures[f], None, e
+
+def delete_instance(client, inst_id):
+    try:
+        client.delete('/cloud/project/{}/instance/{}'.format(client._project, inst_id))
+    except APIError:
+        raise
+
+def delete_instances(client, instances, parallelism=1):
+    """Submit instance deletions concurrently
+
+    Yields an (instance, error) tuple for every instance as soon as its
+    request completes, instead of raising on the first APIError.
+    """
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        futures = {executor.submit(delete_instance, client, i['id']): i for i in instances}
+
+        for f in as_completed(futures):
+            try:
+                f.result()
+            except APIError as e:
+                yield futures[f], e
+            else:
+                yield futures[f], None
+
+def delete_priv_network(client, net_id):
+    try:
+        client.delete('/cloud/project/{}/network/private/{}'.format(client._project, net_id))
+    except APIError:
+        raise
+
+def instance_deleted(client, inst_id):
+    """Return whether an instance reached the DELETED status or vanished"""
+
+    try:
+        inst = client.get('/cloud/project/{}/instance/{}'.format(client._project, inst_id))
+    except ResourceNotFoundError:
+        return True
+
+    return inst.get('status') == 'DELETED'
+
+def next_vlan(client, exclude=()):
+    """Return the lowest VLAN id not used by any private network of the project
+
+    Ids listed in 'exclude' are skipped as well. Raises ValueError if all
+    VLAN ids are in use.
+    """
     try:
         networks = client.get('/cloud/project/{}/network/private'.format(client._project))
     except APIError:
         raise
     else:
-        vlans = tuple(n['vlanId'] for n in networks)
+        vlans = {n['vlanId'] for n in networks}
+        vlans.update(exclude)
 
-        for i in range(4001):
+        for i in range(MAX_VLAN + 1):
             if i not in vlans:
                 return i
 
-    return -1
+    raise ValueError('All VLAN ids between 0 and {} are in use'.format(MAX_VLAN))
+
+def vlan_conflict(error):
+    """Return whether an APIError was caused by a VLAN id already in use"""
+
+    response = getattr(error, 'response', None)
+    if response is not None and response.status_code == 409:
+        return True
+
+    return 'vlan' in str(error).lower()
+
+def get_instances(client, ids, parallelism=1):
+    """Fetch instances by id concurrently, skipping those which no longer exist"""
+
+    return _get_many(client, ['/cloud/project/{}/instance/{}'.format(client._project, i) for i in ids], parallelism)
+
+def get_priv_networks(client, ids, parallelism=1):
+    """Fetch private networks by id concurrently, skipping those which no longer exist"""
+
+    return _get_many(client, ['/cloud/project/{}/network/private/{}'.format(client._project, i) for i in ids],
+                     parallelism)
+
+def _get_many(client, paths, parallelism):
+    def get(path):
+        try:
+            return client.get(path)
+        except ResourceNotFoundError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        return [r for r in executor.map(get, paths) if r is not None]
+
+def get_clusters(client):
+    """Return all clusters of the project, grouped by name
+
+    Instances and private networks are listed concurrently, then grouped in
+    a single pass by the 'kovh:<name>:' prefix of their name. Returns a dict
+    mapping cluster names to {'instances': [...], 'networks': [...]}.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        all_inst = executor.submit(client.get, '/cloud/project/{}/instance'.format(client._project))
+        all_netw = executor.submit(client.get, '/cloud/project/{}/network/private'.format(client._project))
+
+        try:
+            all_inst, all_netw = all_inst.result(), all_netw.result()
+        except APIError:
+            raise
+
+    clusters = {}
+
+    # instances are named 'kovh:<name>::<host>'
+    for inst in all_inst:
+        if inst['name'].startswith('kovh:'):
+            name, sep, _ = inst['name'][5:].rpartition('::')
+            if sep:
+                clusters.setdefault(name, {'instances': [], 'networks': []})['instances'].append(inst)
+
+    # networks are named 'kovh:<name>:'
+    for netw in all_netw:
+        if netw['name'].startswith('kovh:') and netw['name'].endswith(':'):
+            clusters.setdefault(netw['name'][5:-1], {'instances': [], 'networks': []})['networks'].append(netw)
+
+    return clusters
 
 def get_cluster_instances(client, name):
     instances = []
@@ -0,0 +1,102 @@
+from OpenSSL            import crypto
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os                 import open as os_open, fdopen, O_CREAT, O_RDWR
+from os.path            import join, isfile
+from re                 import findall, DOTALL
+
+from .ca    import _new_key
+from .utils import data_dir, LockedFile
+
+
+class KeyPool:
+    """Pool of pre-generated X.509 keys
+
+    Keys are stored encrypted in a single PEM file only readable by its owner,
+    and consumed by the CA in place of inline key generation.
+    """
+
+    def __init__(self, passphrase, key_type='rsa2048', path=None):
+        self.key_type = key_type
+
+        if path is None:
+            path = join(data_dir(), 'keypool-{}.pem'.format(key_type))
+        self.path = path
+
+        self._passphrase = passphrase.encode() if isinstance(passphrase, str) else passphrase
+
+    def __len__(self):
+        if not isfile(self.path):
+            return 0
+
+        with self._open() as f:
+            return len(_split(f.read()))
+
+    def fill(self, count, workers=None):
+        """Generate 'count' keys in a process pool and add them to the pool
+
+        Keys are written as soon as they are generated, a concurrent 'create'
+        can therefore consume them before the pool is completely filled.
+        """
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_gen_key_pem, self.key_type) for _ in range(count)]
+
+            for f in as_completed(futures):
+                key = crypto.load_privatekey(crypto.FILETYPE_PEM, f.result())
+                self.put([key])
+
+    def put(self, keys):
+        """Add keys to the pool"""
+
+        pems = b''.join(crypto.dump_privatekey(crypto.FILETYPE_PEM, k, 'aes256', self._passphrase) for k in keys)
+
+        with self._open() as f:
+            f.seek(0, 2)
+            f.write(pems)
+
+    def take(self, count=1):
+        """Remove up to 'count' keys from the pool and return them
+
+        Returns fewer keys than requested when the pool runs dry. Entries that
+        can't be decrypted with the current passphrase are discarded.
+        """
+        if not isfile(self.path):
+            return []
+
+        with self._open() as f:
+            pems = _split(f.read())
+            taken, kept = pems[:count], pems[count:]
+
+            f.seek(0)
+            f.truncate()
+            f.write(b''.join(kept))
+
+        keys = []
+        for pem in taken:
+            try:
+                keys.append(crypto.load_privatekey(crypto.FILETYPE_PEM, pem, self._passphrase))
+            except crypto.Error:
+                pass
+
+        return keys
+
+    def clear(self):
+        """Remove all keys from the pool"""
+
+        with self._open() as f:
+            f.truncate()
+
+    def _open(self):
+        """Open the pool file with an exclusive lock and owner-only permissions"""
+
+        return LockedFile(fdopen(os_open(self.path, O_CREAT | O_RDWR, 0o600), 'r+b'))
+
+
+def _split(data):
+    """Split concatenated PEM blocks"""
+
+    return findall(rb'-----BEGIN [A-Z ]+-----.+?-----END [A-Z ]+-----\n', data, DOTALL)
+
+def _gen_key_pem(key_type):
+    """Process pool entry point generating a single key"""
+
+    return crypto.dump_privatekey(crypto.FILETYPE_PEM, _new_key(key_type))
@@ -6,6 +6,10 @@ Usage:
 
 Options:
   -c, --config FILE   Alternate configuration file for the OVH client [default: kovh.conf]
+  -r, --refresh       Ignore cached catalog data (flavors, images, regions)
+  -S, --stats         Print API client statistics after the command
+  -T, --trace         Print the duration of command phases and API calls
+  --trace-out FILE    Also export traces to FILE in the Chrome trace event format
   -h, --help          Show this screen
   -V, --version       Display version
 
@@ -14,28 +18,34 @@ Commands:
   project   Cloud project administration
   create    Create Kubernetes cluster
   destroy   Destroy Kubernetes cluster
+  scale     Add or remove nodes of a Kubernetes cluster
+  list      List Kubernetes clusters
+  render    Generate User Data of a cluster locally
+  keypool   Manage pre-generated keys
+  cache     Manage cached catalog data
 
 Use 'kovh <command> -h' for more information about a given command.
 """
 
 from docopt         import docopt
-from ovh            import APIError, ResourceNotFoundError
+from ovh            import APIError
 from inspect        import cleandoc
 from json           import dumps
 from sys            import exit
-from os             import getlogin
+from os             import environ
 from os.path        import realpath, expanduser
-from time           import sleep
-from ipaddress      import IPv4Network
 #from OpenSSL.crypto import dump_certificate, dump_privatekey, FILETYPE_PEM
 
+# modules only required by some commands are imported by the command itself
+# to keep the startup time of every other command low
 from .       import __version__
-from .       import project
-from .       import infra
 from .client import Client
-from .host   import Host
-from .ca     import CA
-from .auth   import get_current_cred
+from .trace  import tracer
+from .utils  import columns
+
+
+# number of VLAN ids tried after a conflict before giving up
+VLAN_RETRIES = 3
 
 
 def main():
@@ -43,16 +53,45 @@ def main():
                    version='kOHVernetes version {}'.format(__version__),
                    options_first=True)
 
+    command = args['<command>']
+
+    # KOVH_TRACE is either a boolean flag or the path traces are exported to
+    trace_env = environ.get('KOVH_TRACE', '')
+    trace_on = trace_env.lower() in ('1', 'true', 'yes', 'on')
+    trace_off = trace_env.lower() in ('', '0', 'false', 'no', 'off')
+    trace_out = args['--trace-out'] or (trace_env if not (trace_on or trace_off) else None)
+    if args['--trace'] or trace_out or trace_on:
+        tracer.enable()
+
+    # traces are reported even if the command fails
+    try:
+        with tracer.span('kovh {}'.format(command), 'command'):
+            run_command(command, args)
+    finally:
+        if tracer.enabled:
+            print_trace(trace_out)
+
+
+def run_command(command, args):
+    """Create the API client and dispatch to the command"""
+
+    # works offline, without configuration
+    if command == 'render':
+        render_command(None, args['<arg>'])
+        return
+
     # create a client using configuration
-    c = Client(config_file=realpath(args.get('--config')))
+    try:
+        c = Client(config_file=realpath(args.get('--config')), refresh=args['--refresh'])
+    except ValueError as e:
+        print(e)
+        exit(1)
     if not (c._application_key and c._application_secret):
         print("Missing 'application_key' and/or 'application_secret' from configuration")
         print('Create a new application at:')
         print(' * {}/createApp'.format(c._endpoint[:-4]))
         exit(1)
 
-    command = args['<command>']
-
     # TODO: check credential validity on APIError, too expensive to check before every command
     #if not has_valid_cred(c):
     #    print('Authentication denied')
@@ -66,6 +105,97 @@ def main():
         create_command(c, args['<arg>'])
     elif command == 'destroy':
         destroy_command(c, args['<arg>'])
+    elif command == 'scale':
+        scale_command(c, args['<arg>'])
+    elif command == 'list':
+        list_command(c, args['<arg>'])
+    elif command == 'keypool':
+        keypool_command(c, args['<arg>'])
+    elif command == 'cache':
+        cache_command(c, args['<arg>'])
+
+    if args['--stats']:
+        print_stats(c)
+
+
+def print_trace(path=None):
+    """Print a summary of recorded spans, and export them to path if given"""
+
+    summary = tracer.summary()
+    if summary:
+        print(columns(
+            ['CATEGORY', 'SPAN', 'COUNT', 'TOTAL (ms)', 'MAX (ms)'],
+            [(cat, name, n, round(total * 1000), round(longest * 1000)) for cat, name, n, total, longest in summary]
+        ))
+
+    if path:
+        tracer.export(path)
+        print("Traces exported to '{}'".format(path))
+
+
+def print_stats(client):
+    """Print API client statistics"""
+
+    print('API cache: {} hits, {} misses'.format(client.cache.hits, client.cache.misses))
+    print('Disk cache: {} hits, {} misses'.format(client.disk_cache.hits, client.disk_cache.misses))
+    print('HTTP connections: {} opened for {} requests'.format(*client.connection_stats()))
+
+    report = client.metrics.report()
+    if report:
+        print(columns(
+            ['ENDPOINT', 'REQUESTS', 'AVG (ms)', 'MAX (ms)', 'RETRIES', 'ERRORS'],
+            [(e, n, round(avg * 1000), round(longest * 1000), retries, errors)
+             for e, n, avg, longest, retries, errors in report]
+        ))
+
+
+def parse_number(args, option, positive=False):
+    """Return the integer value of a command option, exit if it isn't a (positive) number"""
+
+    try:
+        value = int(args[option])
+        if positive and value < 1:
+            raise ValueError
+    except ValueError as e:
+        print("Option {} expects a {}number, got '{}'".format(option, 'positive ' if positive else '', args[option]))
+        exit(1)
+
+    return value
+
+
+def external_assets(client, args):
+    """Return the AssetStore selected by --external-assets, or None if the option isn't set"""
+
+    from .assets import AssetStore
+
+    if not args['--external-assets']:
+        return None
+
+    if not client._assets_url:
+        print("Option --external-assets requires 'assets_url' in configuration")
+        exit(1)
+
+    return AssetStore(client._assets_url, client._assets_token)
+
+
+def report_userdata(hosts):
+    """Print the User Data size of hosts, detailed for those exceeding the API limit
+
+    Returns the hosts whose User Data exceeds the limit.
+    """
+    from .host import USERDATA_MAX_SIZE
+
+    print(columns(
+        ['HOST', 'USER DATA', 'FREE'],
+        [(h.name, str(h.userdata_size()), str(USERDATA_MAX_SIZE - h.userdata_size())) for h in hosts]
+    ))
+
+    oversized = [h for h in hosts if not h.userdata_fits()]
+    for h in oversized:
+        print("User Data of '{}' exceeds {} bytes (base64-encoded):".format(h.name, USERDATA_MAX_SIZE))
+        print(columns(['FILE', 'SIZE'], [(f, str(sz)) for f, sz in h.userdata.size_report()]))
+
+    return oversized
 
 
 def auth_command(client, args):
@@ -79,6 +209,8 @@ def auth_command(client, args):
     """
     args = docopt(cleandoc(auth_command.__doc__), args)
 
+    from .auth import get_current_cred
+
     command = args['<command>']
 
     if command == 'show':
@@ -119,7 +251,7 @@ def auth_command(client, args):
 def project_command(client, args):
     """Get information about cloud projects
 
-    Usage: project <command>
+    Usage: project <command> [-o FORMAT]
 
     Commands:
       flavors     List available instance flavors for active project
@@ -132,57 +264,92 @@ def project_command(client, args):
       snapshots   List available snapshots for active project
       show        Display active project configuration
       usage       Show costs of active project for the current month
+
+    Options:
+      -o, --output FORMAT   Output format of listings, table, json, jsonl or csv [default: table]
     """
     args = docopt(cleandoc(project_command.__doc__), args)
 
+    from .      import project
+    from .utils import write_rows, OUTPUT_FORMATS
+
     command = args['<command>']
 
+    if args['--output'] not in OUTPUT_FORMATS:
+        print("Option --output expects one of {}, got '{}'".format(', '.join(OUTPUT_FORMATS), args['--output']))
+        exit(1)
+
     # TODO: need a command dispatcher there
     # https://github.com/ansible/ansible/blob/5553b20/lib/ansible/module_utils/basic.py#L776-L789
 
-    # TODO: catch APIError exceptions
+    listings = {
+        'flavors': project.get_flavors,
+        'images': project.get_images,
+        'instances': project.get_instances,
+        'keys': project.get_keys,
+        'networks': project.get_networks,
+        'regions': project.get_regions,
+        'services': project.get_services,
+        'snapshots': project.get_snapshots,
+        'usage': project.get_usage
+    }
 
     if command == 'show':
         print('Project: {}'.format(client._project if client._project else '-'))
         print('Region: {}'.format(client._region if client._region else '-'))
         print('SSH key: {}'.format(client._sshkey if client._sshkey else '-'))
-    elif command == 'services':
-        print(project.get_services(client))
-    else:
-        missing_params = client.missing_params(['project'])
-        if missing_params:
-            print('Missing parameters from configuration:', ', '.join(["'{}'".format(x) for x in missing_params]))
-            exit(1)
+    elif command in listings:
+        if command != 'services':
+            missing_params = client.missing_params(['project'])
+            if missing_params:
+                print('Missing parameters from configuration:', ', '.join(["'{}'".format(x) for x in missing_params]))
+                exit(1)
 
-        if command == 'flavors':
-            print(project.get_flavors(client))
-        elif command == 'images':
-            print(project.get_images(client))
-        elif command == 'instances':
-            print(project.get_instances(client))
-        elif command == 'keys':
-            print(project.get_keys(client))
-        elif command == 'networks':
-            print(project.get_networks(client))
-        elif command == 'regions':
-            print(project.get_regions(client))
-        elif command == 'snapshots':
-            print(project.get_snapshots(client))
-        elif command == 'usage':
-            print(project.get_usage(client))
+        try:
+            write_rows(*listings[command](client), fmt=args['--output'])
+        except APIError as e:
+            print(e)
+            exit(1)
 
 
 def create_command(client, args):
     """Create a Kubernetes cluster
 
-    Usage: create -n NAME [-s SIZE]
+    Progress is recorded locally after every step. Running the command again
+    after a failure resumes the creation with the options of the first run,
+    '--rollback' destroys the resources created so far instead.
+
+    Usage: create -n NAME [-s SIZE] [-p NUM] [-k TYPE] [-t SECS] [--cidr CIDR]
+                   [--external-assets] [--lock]
+           create -n NAME --rollback [-p NUM] [-t SECS]
 
     Options:
-      -n, --name NAME   Cluster name
-      -s, --size SIZE   Cluster size [default: 3]
+      -n, --name NAME         Cluster name
+      -s, --size SIZE         Cluster size [default: 3]
+      -p, --parallelism NUM   Number of concurrent instance creations [default: 4]
+      -k, --key-type TYPE     Type of cluster keys, rsa2048 or ecdsa-p256 [default: rsa2048]
+      -t, --timeout SECS      Maximum time to wait for the private network [default: 600]
+      --cidr CIDR             Address range of the private network [default: 192.168.0.0/27]
+      --external-assets       Serve cluster-wide assets from the object storage set by 'assets_url'
+      --lock                  Serialize VLAN allocation with other kovh processes of this machine
+      --rollback              Destroy the resources of an interrupted creation
     """
     args = docopt(cleandoc(create_command.__doc__), args)
 
+    from contextlib     import ExitStack
+    from ipaddress      import IPv4Network
+    from os.path        import join
+    from OpenSSL.crypto import Error as CryptoError
+    from requests       import RequestException
+
+    from .          import project, infra, waiter
+    from .ca        import CA, KEY_TYPES
+    from .host      import Host, make_master, make_node
+    from .index     import ClusterIndex
+    from .keypool   import KeyPool
+    from .userdata  import Fragments
+    from .utils     import data_dir, LockedFile
+
     missing_params = client.missing_params(['project', 'region', 'sshkey', 'flavor'])
     if missing_params:
         print('Missing parameters from configuration:', ', '.join(["'{}'".format(x) for x in missing_params ]))
@@ -190,116 +357,251 @@ def create_command(client, args):
 
     name = args['--name']
     longname = 'kovh:{}:'.format(name)
+
+    index = ClusterIndex(client._project)
+    record = index.get(name)
+    state = record.get('state') if record is not None and not record['complete'] else None
+
+    if args['--rollback']:
+        if record is None or record['complete']:
+            print("No interrupted creation of cluster '{}' to roll back".format(name))
+            exit(1)
+        # instances submitted right before an interruption may be missing from the record
+        destroy_command(client, ['-n', name, '-p', args['--parallelism'], '-t', args['--timeout'], '--rescan'])
+        return
+
+    if record is not None and record['complete']:
+        print("Cluster '{}' already exists".format(name))
+        exit(1)
+    if record is not None and state is None:
+        print("Creation of cluster '{}' can't be resumed, undo it with --rollback".format(name))
+        exit(1)
+
+    # a resumed creation keeps the options of the first run
+    if state is not None:
+        args['--size'], args['--key-type'], args['--cidr'] = str(state['size']), state['key_type'], state['cidr']
+        print("Resuming creation of cluster '{}' ({} instances in {})".format(name, state['size'], state['cidr']))
+
+    size = parse_number(args, '--size', positive=True)
+    parallelism = parse_number(args, '--parallelism', positive=True)
+
+    key_type = args['--key-type']
+    if key_type not in KEY_TYPES:
+        print("Option --key-type expects one of {}, got '{}'".format(', '.join(KEY_TYPES), key_type))
+        exit(1)
+    timeout = parse_number(args, '--timeout')
+
     try:
-        size = int(args['--size'])
+        subnet = IPv4Network(args['--cidr'])
     except ValueError as e:
-        print("Option --size expects a number, got '{}'".format(args['--size']))
+        print("Option --cidr expects an IPv4 network, got '{}'".format(args['--cidr']))
         exit(1)
+    for reserved in (infra.POD_NETWORK, infra.SERVICE_NETWORK):
+        if subnet.overlaps(reserved):
+            print("Option --cidr overlaps the cluster network {}".format(reserved))
+            exit(1)
 
+    # addresses are allocated deterministically, a resumed creation gets the same ones
+    allocator = infra.IPAllocator(subnet)
     try:
-        pub_net_id = project.get_public_networks(client)[0]
-    except APIError as e:
-        print(e)
+        ips = allocator.allocate(size)
+    except ValueError as e:
+        print("Cluster of {} instances doesn't fit in {}, use a larger --cidr".format(size, subnet))
         exit(1)
 
-    try:
-        vlan_id = infra.next_vlan(client)
-    except APIError as e:
+    assets = external_assets(client, args)
+
+    def abort(e):
         print(e)
+        print("Run 'kovh create -n {0}' again to resume, or 'kovh create -n {0} --rollback' to undo".format(name))
         exit(1)
 
-    # TODO: rollback on failure
+    # resources left by the interrupted creation
+    priv_net = None
+    existing = {}
+    if state is not None:
+        with tracer.span('create: cluster lookup'):
+            try:
+                if record['networks']:
+                    networks = infra.get_priv_networks(client, record['networks'])
+                else:
+                    networks = infra.get_cluster_networks(client, longname)
+                instances = infra.get_cluster_instances(client, longname)
+            except APIError as e:
+                abort(e)
+
+        priv_net = next((n for n in networks if n['name'] == longname), None)
+        existing = {i['name']: i for i in instances if i['status'] not in ('DELETING', 'DELETED')}
 
-    print("Creating private network '{}' with VLAN id {}".format(longname, vlan_id), end='', flush=True)
+    # the image is resolved once for all hosts
     try:
-        priv_net = infra.create_priv_network(client, longname, vlan_id)
+        pub_net_id = project.get_public_networks(client)[0]
+        image = project.get_coreos_images(client)[0]
     except APIError as e:
         print(e)
         exit(1)
 
-    print('\t[OK]')
+    hostnames = ['{}:master'.format(longname)] + ['{}:node{:02}'.format(longname, i) for i in range(1, size)]
+    pending = [i for i, h in enumerate(hostnames) if h not in existing]
+    submitted = [existing[h]['id'] for h in hostnames if h in existing]
 
-    print("Waiting for readiness of private network '{}'".format(longname), end='', flush=True)
+    # User Data is generated before creating any resource, so that oversized
+    # User Data fails the command before anything needs to be cleaned up
 
-    network_active = False
-    while not network_active:
-        try:
-            network_detail = client.get('/cloud/project/{}/network/private/{}'.format(client._project, priv_net['id']))
-            if network_detail.get('status') == 'ACTIVE':
-                network_active = True
-        except ResourceNotFoundError:
-            pass
+    with tracer.span('create: certificate authority'):
+        ca = index.get_ca(name) if state is not None else None
+        if ca is not None:
+            try:
+                k8s_ca = CA.load(ca, client._application_secret, KeyPool(client._application_secret, key_type))
+            except CryptoError as e:
+                abort("CA of cluster '{}' can't be decrypted, was 'application_secret' changed?".format(name))
+        elif submitted:
+            abort("CA of cluster '{}' is not recorded on this machine".format(name))
+        else:
+            print('Creating Certificate Authority', end='', flush=True)
+            k8s_ca = CA(key_type, KeyPool(client._application_secret, key_type))
+            print('\t[OK]')
 
-        print('.', end='', flush=True)
-        sleep(1)
+    with tracer.span('create: certificates'):
+        print('Issuing certificates', end='', flush=True)
+        pki = k8s_ca.issue_batch([Host.pki_request(['master', 'node'] if i == 0 else ['node'], ips[i])
+                                  for i in pending])
+        print('\t[OK]')
 
-    print('\t[OK]')
+    with tracer.span('create: user data'):
+        print('Generating User Data', end='', flush=True)
+        fragments = Fragments(assets)
+        try:
+            hosts = [make_master(longname, ips[0], ips, pub_net_id, client, k8s_ca, p, fragments, image) if i == 0
+                     else make_node(longname, i, ips[i], ips, pub_net_id, client, k8s_ca, p, fragments, image)
+                     for i, p in zip(pending, pki)]
+        except (APIError, RequestException) as e:
+            print(e)
+            exit(1)
 
-    subnet = IPv4Network('192.168.0.0/27')
+        print('\t[OK]')
 
-    print('Creating subnet', end='', flush=True)
-    try:
-        infra.create_subnet(client, priv_net['id'], subnet)
-    except APIError as e:
-        print(e)
+    if assets is not None:
+        print('Assets: {} uploaded, {} reused'.format(assets.uploaded, assets.reused))
+
+    if report_userdata(hosts):
         exit(1)
 
-    print('\t[OK]')
-
-    print('Creating Certificate Authority', end='', flush=True)
-    k8s_ca = CA()
-    print('\t[OK]')
-
-    print('Generating User Data', end='', flush=True)
-    hosts = subnet.hosts()
-    for _ in range(10):
-        next_ip = next(hosts)
-
-    master = Host(
-        name='{}:master'.format(longname),
-        roles=['master', 'node'],
-        pub_net=pub_net_id,
-        priv_net=priv_net['id'],
-        client=client,
-        ca=k8s_ca,
-        ip=str(next_ip)
-    )
-    for c in ('kubelet', 'proxy', 'controller-manager', 'scheduler'):
-        master.userdata.gen_kubeconfig(c)
-
-    nodes = []
-    for i in range(1, size):
-        next_ip = next(hosts)
-        node = Host(
-            name='{}:node{:02}'.format(longname, i),
-            roles=['node'],
-            pub_net=pub_net_id,
-            priv_net=priv_net['id'],
-            client=client,
-            ca=k8s_ca,
-            ip=str(next_ip)
-        )
-        for c in ('kubelet', 'proxy'):
-            node.userdata.gen_kubeconfig(c, 'host-' + master.ip.replace('.', '-'))
-        nodes.append(node)
+    # record the cluster before creating anything, it stays incomplete until
+    # all instances are submitted, along with the CA and the serials it used
+    if state is None:
+        state = {'size': size, 'key_type': key_type, 'cidr': str(subnet), 'subnet': False}
+    networks = [priv_net['id']] if priv_net is not None else []
+    index.set(name, submitted, networks, complete=False, state=state)
+    index.set_ca(name, k8s_ca.dump(client._application_secret))
+
+    if priv_net is None:
+        with tracer.span('create: private network'), ExitStack() as stack:
+            # hold the lock until the network is visible to other processes
+            if args['--lock']:
+                stack.enter_context(LockedFile(open(join(data_dir(), 'vlan.lock'), 'a')))
+
+            # VLAN ids taken by concurrent creations since they were listed
+            conflicts = set()
+            while True:
+                try:
+                    vlan_id = infra.next_vlan(client, conflicts)
+                except (APIError, ValueError) as e:
+                    abort(e)
 
-    print('\t[OK]')
+                print("Creating private network '{}' with VLAN id {}".format(longname, vlan_id), end='', flush=True)
+                try:
+                    priv_net = infra.create_priv_network(client, longname, vlan_id)
+                except APIError as e:
+                    if infra.vlan_conflict(e) and len(conflicts) < VLAN_RETRIES:
+                        print('\t[CONFLICT]')
+                        conflicts.add(vlan_id)
+                        continue
+                    abort(e)
 
-    print('Creating instances', end='', flush=True)
-    try:
-        client.post('/cloud/project/{}/instance'.format(client._project), **master.make_body())
-    except APIError as e:
-        print(e)
-        exit(1)
+                break
+
+        print('\t[OK]')
+
+        index.set(name, submitted, [priv_net['id']], complete=False, state=state)
+
+    with tracer.span('create: private network readiness'):
+        print("Waiting for readiness of private network '{}'".format(longname), end='', flush=True)
 
-    for node in nodes:
         try:
-            client.post('/cloud/project/{}/instance'.format(client._project), **node.make_body())
+            pending_nets = waiter.wait([priv_net['id']], lambda n: infra.network_active(client, n), timeout,
+                                       progress=lambda: print('.', end='', flush=True))
         except APIError as e:
-            print(e)
-            exit(1)
+            abort(e)
+
+        if pending_nets:
+            print('\t[TIMEOUT]')
+            abort("Private network still pending: '{}'".format(longname))
+
+        print('\t[OK]')
+
+    # the subnet may have been created right before an interruption
+    if not state['subnet'] and record is not None:
+        try:
+            infra.get_subnet(client, priv_net['id'])
+        except ValueError:
+            pass
+        except APIError as e:
+            abort(e)
+        else:
+            state['subnet'] = True
 
-    print('\t[OK]')
+    if not state['subnet']:
+        with tracer.span('create: subnet'):
+            print('Creating subnet', end='', flush=True)
+            try:
+                infra.create_subnet(client, priv_net['id'], subnet)
+            except APIError as e:
+                abort(e)
+
+            print('\t[OK]')
+
+        state['subnet'] = True
+        index.set(name, submitted, [priv_net['id']], complete=False, state=state)
+
+    for h in hosts:
+        h.priv_net = priv_net['id']
+
+    # the master is always submitted first, nodes are then submitted concurrently
+    failed = []
+    with tracer.span('create: instances'):
+        nodes = hosts
+        if pending and pending[0] == 0:
+            master, nodes = hosts[0], hosts[1:]
+
+            print("Creating instance '{}'".format(master.name), end='', flush=True)
+            try:
+                inst = infra.create_instance(client, master.make_body())
+            except APIError as e:
+                abort(e)
+
+            print('\t[OK]')
+
+            submitted.append(inst['id'])
+            index.set(name, submitted, [priv_net['id']], complete=False, state=state)
+
+        for node, inst, err in infra.create_instances(client, nodes, parallelism):
+            if err is None:
+                print("Creating instance '{}'\t[OK]".format(node.name))
+                submitted.append(inst['id'])
+                index.set(name, submitted, [priv_net['id']], complete=False, state=state)
+            else:
+                print("Creating instance '{}'\t[FAILED]".format(node.name))
+                failed.append((node, err))
+
+    # the creation is only complete once all instances are submitted
+    index.set(name, submitted, [priv_net['id']], complete=not failed, state=state if failed else None)
+
+    print('Created {} of {} instances'.format(len(hosts) - len(failed), len(hosts)))
+    if failed:
+        for node, err in failed:
+            print(" * '{}': {}".format(node.name, err))
+        abort('{} instances failed'.format(len(failed)))
 
     # TODO: generate local kubeconfig file
     #print('Creating local kubeconfig', end='', flush=True)
@@ -317,65 +619,516 @@ def create_command(client, args):
 def destroy_command(client, args):
     """Destroy a Kubernetes cluster
 
-    Usage: destroy -n NAME
+    Usage: destroy -n NAME [-t SECS] [-p NUM] [--no-wait] [--rescan]
 
     Options:
-      -n, --name NAME   Cluster name
+      -n, --name NAME         Cluster name
+      -t, --timeout SECS      Maximum time to wait for instances termination [default: 600]
+      -p, --parallelism NUM   Number of concurrent instance deletions [default: 8]
+      --no-wait               Return as soon as instance deletions are accepted
+      --rescan                Search all project resources instead of the local cluster index
     """
     args = docopt(cleandoc(destroy_command.__doc__), args)
 
+    from .      import infra, waiter
+    from .index import ClusterIndex
+
     missing_params = client.missing_params(['project'])
     if missing_params:
         print('Missing parameters from configuration:', ', '.join(["'{}'".format(x) for x in missing_params ]))
         exit(1)
 
     longname = 'kovh:{}:'.format(args['--name'])
+    timeout = parse_number(args, '--timeout')
+    parallelism = parse_number(args, '--parallelism', positive=True)
 
+    # clusters created by this machine are resolved by id, others require
+    # listing all resources of the project
+    index = ClusterIndex(client._project)
+    record = index.get(args['--name'])
+
+    with tracer.span('destroy: cluster lookup'):
+        try:
+            if record is not None and record['complete'] and not args['--rescan']:
+                del_instances = infra.get_instances(client, record['instances'], parallelism)
+                del_networks = infra.get_priv_networks(client, record['networks'], parallelism)
+            else:
+                del_instances = infra.get_cluster_instances(client, longname)
+                del_networks = infra.get_cluster_networks(client, longname)
+        except APIError as e:
+            print(e)
+            exit(1)
+
+    failed = []
+
+    with tracer.span('destroy: instances'):
+        deleting = []
+        for inst, err in infra.delete_instances(client, del_instances, parallelism):
+            if err is None:
+                print("Destroying instance '{}'\t[OK]".format(inst['name']))
+                deleting.append(inst)
+            else:
+                print("Destroying instance '{}'\t[FAILED]".format(inst['name']))
+                failed.append((inst['name'], err))
+
+    if args['--no-wait']:
+        if del_networks:
+            print("Private networks are kept until instances are terminated, run 'destroy' again to remove them")
+    else:
+        if deleting:
+            print('Waiting for instances termination', end='', flush=True)
+
+            with tracer.span('destroy: instances termination'):
+                try:
+                    pending = waiter.wait([inst['id'] for inst in deleting],
+                                          lambda i: infra.instance_deleted(client, i), timeout,
+                                          parallelism=parallelism, progress=lambda: print('.', end='', flush=True))
+                except APIError as e:
+                    print(e)
+                    exit(1)
+
+                if pending:
+                    print('\t[TIMEOUT]')
+                    print('Instances still pending:', ', '.join(["'{}'".format(i['name']) for i in deleting
+                                                                 if i['id'] in pending]))
+                    exit(1)
+
+                print('\t[OK]')
+
+        # networks can only be removed once all their instances are gone
+        if not failed:
+            with tracer.span('destroy: private networks'):
+                for netw in del_networks:
+                    print("Destroying private network '{}'".format(netw['name']), end='', flush=True)
+                    try:
+                        infra.delete_priv_network(client, netw['id'])
+                    except APIError as e:
+                        print('\t[FAILED]')
+                        failed.append((netw['name'], e))
+                    else:
+                        print('\t[OK]')
+
+            if not failed:
+                index.remove(args['--name'])
+
+    if failed:
+        print('Failed to destroy {} resources'.format(len(failed)))
+        for name, err in failed:
+            print(" * '{}': {}".format(name, err))
+        exit(1)
+
+def scale_command(client, args):
+    """Add or remove nodes of a Kubernetes cluster
+
+    Missing nodes are created with certificates issued by the CA recorded
+    when the cluster was created, surplus nodes are destroyed starting with
+    the highest-numbered one. Other hosts are left untouched.
+
+    Usage: scale -n NAME -s SIZE [-p NUM] [--rescan] [--external-assets]
+
+    Options:
+      -n, --name NAME         Cluster name
+      -s, --size SIZE         Cluster size, including the master
+      -p, --parallelism NUM   Number of concurrent instance creations and deletions [default: 4]
+      --rescan                Search all project resources instead of the local cluster index
+      --external-assets       Serve cluster-wide assets from the object storage set by 'assets_url'
+    """
+    args = docopt(cleandoc(scale_command.__doc__), args)
+
+    from OpenSSL.crypto import Error as CryptoError
+    from re             import fullmatch
+    from requests       import RequestException
+
+    from .          import project, infra
+    from .ca        import CA
+    from .host      import Host, make_node
+    from .index     import ClusterIndex
+    from .keypool   import KeyPool
+    from .userdata  import Fragments
+
+    missing_params = client.missing_params(['project', 'region', 'sshkey', 'flavor'])
+    if missing_params:
+        print('Missing parameters from configuration:', ', '.join(["'{}'".format(x) for x in missing_params ]))
+        exit(1)
+
+    name = args['--name']
+    longname = 'kovh:{}:'.format(name)
+    size = parse_number(args, '--size', positive=True)
+    parallelism = parse_number(args, '--parallelism', positive=True)
+
+    assets = external_assets(client, args)
+
+    index = ClusterIndex(client._project)
+    record = index.get(name)
+
+    # scaling would overwrite the state the creation is resumed from
+    if record is not None and not record['complete']:
+        print("Creation of cluster '{0}' was interrupted, run 'kovh create -n {0}' to resume it "
+              "or 'kovh create -n {0} --rollback' to undo it".format(name))
+        exit(1)
+
+    with tracer.span('scale: cluster lookup'):
+        try:
+            if record is not None and not args['--rescan']:
+                instances = infra.get_instances(client, record['instances'], parallelism)
+                networks = infra.get_priv_networks(client, record['networks'], parallelism)
+            else:
+                instances = infra.get_cluster_instances(client, longname)
+                networks = infra.get_cluster_networks(client, longname)
+        except APIError as e:
+            print(e)
+            exit(1)
+
+    # instances being deleted no longer count as members
+    instances = [i for i in instances if i['status'] not in ('DELETING', 'DELETED')]
+
+    master = None
+    nodes = {}
+    for inst in instances:
+        host = inst['name'][len(longname)+1:]
+        m = fullmatch(r'node(\d+)', host)
+        if host == 'master':
+            master = inst
+        elif m:
+            nodes[int(m.group(1))] = inst
+
+    if master is None or not networks:
+        print("Cluster '{}' has no master and/or private network".format(name))
+        exit(1)
+
+    if size - 1 == len(nodes):
+        print("Cluster '{}' already has {} instances".format(name, size))
+        return
+
+    failed = []
+
+    if size - 1 < len(nodes):
+        surplus = [nodes[n] for n in sorted(nodes)[size-1:]]
+
+        deleted = set()
+        with tracer.span('scale: instance deletions'):
+            for inst, err in infra.delete_instances(client, surplus, parallelism):
+                if err is None:
+                    print("Destroying instance '{}'\t[OK]".format(inst['name']))
+                    deleted.add(inst['id'])
+                else:
+                    print("Destroying instance '{}'\t[FAILED]".format(inst['name']))
+                    failed.append((inst['name'], err))
+
+        index.set(name, [i['id'] for i in instances if i['id'] not in deleted], [n['id'] for n in networks])
+
+        print('Destroyed {} of {} instances'.format(len(deleted), len(surplus)))
+        if failed:
+            for inst_name, err in failed:
+                print(" * '{}': {}".format(inst_name, err))
+            exit(1)
+        return
+
+    # hosts added later must trust, and be trusted by, the existing ones
+    ca = index.get_ca(name)
+    if ca is None:
+        print("CA of cluster '{}' is not recorded on this machine, nodes can't be added".format(name))
+        exit(1)
     try:
-        del_instances = infra.get_cluster_instances(client, longname)
-    except APIError as e:
+        k8s_ca = CA.load(ca, client._application_secret, KeyPool(client._application_secret, ca['key_type']))
+    except CryptoError as e:
+        print("CA of cluster '{}' can't be decrypted, was 'application_secret' changed?".format(name))
+        exit(1)
+
+    def private_ip(inst):
+        for ip in inst['ipAddresses']:
+            if ip['version'] == 4 and ip.get('type') == 'private':
+                return ip['ip']
+
+    try:
+        subnet = infra.get_subnet(client, networks[0]['id'])
+        pub_net_id = project.get_public_networks(client)[0]
+    except (APIError, ValueError) as e:
         print(e)
         exit(1)
 
-    if del_instances:
-        for inst in del_instances:
-            print("Destroying instance '{}'".format(inst['name']), end='', flush=True)
-            try:
-                client.delete('/cloud/project/{}/instance/{}'.format(client._project, inst['id']))
-            except APIError as e:
-                print(e)
-                exit(1)
-            print('\t[OK]')
+    # the master holds the first address of /etc/hosts, the remaining addresses
+    # of existing hosts are skipped by the allocator
+    cluster_ips = [private_ip(master)] + [private_ip(nodes[n]) for n in sorted(nodes)]
+    if None in cluster_ips:
+        print("Private addresses of cluster '{}' are not assigned yet, retry once instances are ACTIVE".format(name))
+        exit(1)
+    allocator = infra.IPAllocator(subnet, taken=cluster_ips)
 
-        print('Waiting for instances termination', end='', flush=True)
+    # fill the gaps left by removed nodes first
+    numbers = [n for n in range(1, size + len(nodes)) if n not in nodes][:size - 1 - len(nodes)]
+    try:
+        ips = allocator.allocate(len(numbers))
+    except ValueError as e:
+        print("Cluster of {} instances doesn't fit in {}".format(size, subnet))
+        exit(1)
+    cluster_ips += ips
 
-        # TODO: check for deletion asynchronously
-        for inst in del_instances:
-            instance_deleted = False
-            while not instance_deleted:
-                try:
-                    instance_detail = client.get('/cloud/project/{}/instance/{}'.format(client._project, inst['id']))
-                    if instance_detail.get('status') == 'DELETED':
-                        instance_deleted = True
-                except ResourceNotFoundError:
-                    instance_deleted = True
+    with tracer.span('scale: certificates'):
+        print('Issuing certificates', end='', flush=True)
+        pki = k8s_ca.issue_batch([Host.pki_request(['node'], ip) for ip in ips])
+        print('\t[OK]')
 
-                print('.', end='', flush=True)
-                sleep(1)
+    # serial numbers used by the new certificates must not be reused
+    index.set_ca(name, k8s_ca.dump(client._application_secret))
+
+    with tracer.span('scale: user data'):
+        print('Generating User Data', end='', flush=True)
+        fragments = Fragments(assets)
+        try:
+            new_nodes = [make_node(longname, n, ip, cluster_ips, pub_net_id, client, k8s_ca, p, fragments,
+                                   master['imageId'])
+                         for n, ip, p in zip(numbers, ips, pki)]
+        except (APIError, RequestException) as e:
+            print(e)
+            exit(1)
 
         print('\t[OK]')
 
+    if report_userdata(new_nodes):
+        exit(1)
+
+    for h in new_nodes:
+        h.priv_net = networks[0]['id']
+
+    created = []
+    with tracer.span('scale: instances'):
+        for node, inst, err in infra.create_instances(client, new_nodes, parallelism):
+            if err is None:
+                print("Creating instance '{}'\t[OK]".format(node.name))
+                created.append(inst['id'])
+            else:
+                print("Creating instance '{}'\t[FAILED]".format(node.name))
+                failed.append((node.name, err))
+
+    index.set(name, [i['id'] for i in instances] + created, [n['id'] for n in networks])
+
+    print('Created {} of {} instances'.format(len(created), len(new_nodes)))
+    if failed:
+        for node_name, err in failed:
+            print(" * '{}': {}".format(node_name, err))
+        exit(1)
+
+def list_command(client, args):
+    """List Kubernetes clusters
+
+    Usage: list [-o FORMAT]
+
+    Options:
+      -o, --output FORMAT   Output format, table or json [default: table]
+    """
+    args = docopt(cleandoc(list_command.__doc__), args)
+
+    from collections import Counter
+
+    from . import infra
+
+    missing_params = client.missing_params(['project'])
+    if missing_params:
+        print('Missing parameters from configuration:', ', '.join(["'{}'".format(x) for x in missing_params ]))
+        exit(1)
+
+    if args['--output'] not in ('table', 'json'):
+        print("Option --output expects one of table, json, got '{}'".format(args['--output']))
+        exit(1)
+
     try:
-        del_networks = infra.get_cluster_networks(client, longname)
+        clusters = infra.get_clusters(client)
     except APIError as e:
         print(e)
         exit(1)
 
-    for netw in del_networks:
-        print("Destroying private network '{}'".format(netw['name']), end='', flush=True)
-        client.delete('/cloud/project/{}/network/private/{}'.format(client._project, netw['id']))
+    summaries = []
+    for name, members in sorted(clusters.items()):
+        statuses = Counter(inst['status'] for inst in members['instances'])
+        master_ip = ''
+        for inst in members['instances']:
+            if inst['name'].endswith('::master'):
+                master_ip = ','.join(ip['ip'] for ip in inst['ipAddresses']
+                                     if ip['version'] == 4 and ip.get('type') == 'public')
+
+        summaries.append({
+            'name': name,
+            'nodes': len(members['instances']),
+            # a single status when all instances agree, a breakdown otherwise
+            'status': ','.join('{}:{}'.format(s, n) for s, n in sorted(statuses.items()))
+                      if len(statuses) > 1 else ''.join(statuses),
+            'master_ip': master_ip,
+            'instances': [inst['id'] for inst in members['instances']],
+            'networks': [netw['id'] for netw in members['networks']]
+        })
+
+    if args['--output'] == 'json':
+        print(dumps(summaries, indent=4))
+        return
+
+    print(columns(
+        ['NAME', 'NODES', 'STATUS', 'MASTER IP', 'NETWORKS'],
+        [(s['name'], str(s['nodes']), s['status'], s['master_ip'], str(len(s['networks']))) for s in summaries]
+    ))
+
+def render_command(client, args):
+    """Generate the User Data of a Kubernetes cluster locally
+
+    The Ignition config of every instance is written to its own file, without
+    calling the OVH API or creating any resource.
+
+    Usage: render -o DIR -i IMAGE [-n NAME] [-s SIZE] [-k TYPE] [--cidr CIDR]
+
+    Options:
+      -o, --out DIR         Output directory
+      -i, --image IMAGE     Image ID of the instances
+      -n, --name NAME       Cluster name [default: local]
+      -s, --size SIZE       Cluster size [default: 3]
+      -k, --key-type TYPE   Type of cluster keys, rsa2048 or ecdsa-p256 [default: rsa2048]
+      --cidr CIDR           Address range of the private network [default: 192.168.0.0/27]
+    """
+    args = docopt(cleandoc(render_command.__doc__), args)
+
+    from ipaddress import IPv4Network
+    from os        import makedirs
+    from os.path   import join
+
+    from .          import infra
+    from .ca        import CA, KEY_TYPES
+    from .host      import Host, make_cluster
+    from .userdata  import Fragments
+
+    longname = 'kovh:{}:'.format(args['--name'])
+    size = parse_number(args, '--size', positive=True)
+
+    key_type = args['--key-type']
+    if key_type not in KEY_TYPES:
+        print("Option --key-type expects one of {}, got '{}'".format(', '.join(KEY_TYPES), key_type))
+        exit(1)
+
+    try:
+        subnet = IPv4Network(args['--cidr'])
+    except ValueError as e:
+        print("Option --cidr expects an IPv4 network, got '{}'".format(args['--cidr']))
+        exit(1)
+
+    try:
+        ips = infra.IPAllocator(subnet).allocate(size)
+    except ValueError as e:
+        print("Cluster of {} instances doesn't fit in {}, use a larger --cidr".format(size, subnet))
+        exit(1)
+
+    with tracer.span('render: certificate authority'):
+        print('Creating Certificate Authority', end='', flush=True)
+        k8s_ca = CA(key_type)
         print('\t[OK]')
 
+    with tracer.span('render: certificates'):
+        print('Issuing certificates', end='', flush=True)
+        pki = k8s_ca.issue_batch(
+            [Host.pki_request(['master', 'node'], ips[0])] +
+            [Host.pki_request(['node'], ip) for ip in ips[1:]]
+        )
+        print('\t[OK]')
+
+    with tracer.span('render: user data'):
+        print('Generating User Data', end='', flush=True)
+        master, nodes = make_cluster(longname, ips, None, client, k8s_ca, pki, Fragments(), args['--image'])
+        print('\t[OK]')
+
+    with tracer.span('render: ignition configs'):
+        makedirs(args['--out'], exist_ok=True)
+        for h in [master] + nodes:
+            with open(join(args['--out'], h.name[len(longname)+1:] + '.ign'), 'w') as f:
+                f.write(h.make_body()['userData'])
+
+    report_userdata([master] + nodes)
+    print('Ignition configs written to {}'.format(args['--out']))
+
+def keypool_command(client, args):
+    """Manage the pool of pre-generated keys
+
+    Keys are generated ahead of time and consumed by the 'create' command,
+    which falls back to generating keys inline once the pool is empty.
+
+    Usage: keypool <command> [--count NUM] [-k TYPE] [-b]
+
+    Commands:
+      clear    Remove all keys from the pool
+      fill     Generate keys and add them to the pool
+      status   Display the number of keys available in the pool
+
+    Options:
+      --count NUM           Number of keys to generate [default: 50]
+      -k, --key-type TYPE   Type of keys, rsa2048 or ecdsa-p256 [default: rsa2048]
+      -b, --background      Fill the pool from a detached process
+    """
+    args = docopt(cleandoc(keypool_command.__doc__), args)
+
+    from os       import fork, setsid, _exit
+
+    from .ca      import KEY_TYPES
+    from .keypool import KeyPool
+
+    command = args['<command>']
+
+    key_type = args['--key-type']
+    if key_type not in KEY_TYPES:
+        print("Option --key-type expects one of {}, got '{}'".format(', '.join(KEY_TYPES), key_type))
+        exit(1)
+
+    pool = KeyPool(client._application_secret, key_type)
+
+    if command == 'status':
+        print('Keys available: {}'.format(len(pool)))
+        print('Pool file: {}'.format(pool.path))
+    elif command == 'clear':
+        pool.clear()
+        print('Key pool cleared')
+    elif command == 'fill':
+        count = parse_number(args, '--count')
+
+        if args['--background']:
+            pid = fork()
+            if pid:
+                print('Filling key pool with {} keys in process {}'.format(count, pid))
+                return
+            setsid()
+
+            # the child must never return into the parent's code path
+            status = 1
+            try:
+                pool.fill(count)
+                status = 0
+            finally:
+                _exit(status)
+
+        print('Generating {} keys'.format(count), end='', flush=True)
+        pool.fill(count)
+        print('\t[OK]')
+        print('Keys available: {}'.format(len(pool)))
+
+def cache_command(client, args):
+    """Manage cached catalog data
+
+    Flavors, images and regions are cached on disk between invocations
+    until they expire, see 'cache_ttl' in the configuration.
+
+    Usage: cache <command>
+
+    Commands:
+      clear   Remove all cached data
+      stats   Display information about cached data
+    """
+    args = docopt(cleandoc(cache_command.__doc__), args)
+
+    command = args['<command>']
+
+    if command == 'stats':
+        entries, expired, size = client.disk_cache.stats()
+        print('Location: {}'.format(client.disk_cache.path))
+        print('Entries: {} ({} expired)'.format(entries, expired))
+        print('Size: {} bytes'.format(size))
+        print('TTL: {} seconds'.format(client.disk_cache.ttl))
+    elif command == 'clear':
+        print('Removed {} entries'.format(client.disk_cache.clear()))
+
 
 if __name__ == '__main__':
     main()
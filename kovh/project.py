@@ -1,156 +1,172 @@
-from .utils import columns
+from concurrent.futures import ThreadPoolExecutor
 
 
+# maximum number of concurrent API requests issued by listings
+MAX_WORKERS = 8
+
+# region details hardly ever change
+REGION_TTL = 7*24*60*60
+
+
+# Listings return a (headers, rows) tuple where rows is an iterator, so that
+# callers can output every row as soon as it is produced.
+
 def get_flavors(client):
-    flavors = []
     headers = ['ID', 'NAME', 'VCPUS', 'RAM', 'DISK', 'TYPE', 'REGION']
 
     params = {}
     if client._region:
         params['region'] = client._region
 
-    for fl in client.get('/cloud/project/{}/flavor'.format(client._project), **params):
-        if fl['name'][:4] != 'win-':
-            flavors.append(
-                (
+    flavors = client.cached_get('/cloud/project/{}/flavor'.format(client._project), _persist=True, **params)
+
+    def rows():
+        for fl in flavors:
+            if fl['name'][:4] != 'win-':
+                yield (
                     fl['id'],
                     fl['name'],
-                    str(fl['vcpus']),
-                    str(fl['ram']),
-                    str(fl['disk']),
+                    fl['vcpus'],
+                    fl['ram'],
+                    fl['disk'],
                     fl['type'],
                     fl['region']
                 )
-            )
 
-    return columns(headers, flavors)
+    return headers, rows()
 
 def get_images(client):
-    images = []
     headers = ['ID', 'NAME', 'USER', 'REGION']
 
     params = { 'osType': 'linux' }
     if client._region:
         params['region'] = client._region
 
-    for img in client.get('/cloud/project/{}/image'.format(client._project), **params):
-        images.append(
-            (
+    images = client.cached_get('/cloud/project/{}/image'.format(client._project), _persist=True, **params)
+
+    def rows():
+        for img in images:
+            yield (
                 img['id'],
                 img['name'],
                 img['user'],
                 img['region']
             )
-        )
 
-    return columns(headers, images)
+    return headers, rows()
 
 def get_instances(client):
-    instances = []
     headers = ['ID', 'NAME', 'STATUS', 'REGION', 'IP']
 
-    for inst in client.get('/cloud/project/{}/instance'.format(client._project)):
-        ip_addrs = []
-        for ip in inst['ipAddresses']:
-            if ip['version'] == 4:
-                ip_addrs.append(ip['ip'])
+    instances = client.get('/cloud/project/{}/instance'.format(client._project))
+
+    def rows():
+        for inst in instances:
+            ip_addrs = []
+            for ip in inst['ipAddresses']:
+                if ip['version'] == 4:
+                    ip_addrs.append(ip['ip'])
 
-        instances.append(
-            (
+            yield (
                 inst['id'],
                 inst['name'],
                 inst['status'],
                 inst['region'],
                 ','.join(ip_addrs)
             )
-        )
 
-    return columns(headers, instances)
+    return headers, rows()
 
 def get_keys(client):
-    keys = []
     headers = ['ID', 'NAME']
 
-    for key in client.get('/cloud/project/{}/sshkey'.format(client._project)):
-        keys.append(
-            (
+    keys = client.get('/cloud/project/{}/sshkey'.format(client._project))
+
+    def rows():
+        for key in keys:
+            yield (
                 key['id'],
                 key['name']
             )
-        )
 
-    return columns(headers, keys)
+    return headers, rows()
 
 def get_networks(client):
-    networks = []
     headers = ['ID', 'NAME', 'VLAN', 'STATUS']
 
-    for net in client.get('/cloud/project/{}/network/private'.format(client._project)):
-        networks.append(
-            (
+    networks = client.get('/cloud/project/{}/network/private'.format(client._project))
+
+    def rows():
+        for net in networks:
+            yield (
                 net['id'],
                 net['name'],
                 net['vlanId'],
                 net['status']
             )
-        )
 
-    return columns(headers, networks)
+    return headers, rows()
 
 def get_regions(client):
-    regions = []
     headers = ['NAME', 'CONTINENT']
 
-    region_names = client.get('/cloud/project/{}/region'.format(client._project))
-    for r_name in region_names:
-        r_cont = client.get('/cloud/project/{}/region/{}'.format(client._project, r_name))['continentCode']
-        regions.append(
-            (
-                r_name,
-                r_cont
-            )
-        )
+    def continent(r_name):
+        return client.cached_get('/cloud/project/{}/region/{}'.format(client._project, r_name),
+                                 _ttl=REGION_TTL, _persist=True)['continentCode']
+
+    region_names = client.cached_get('/cloud/project/{}/region'.format(client._project), _persist=True)
+
+    def rows():
+        # details are fetched concurrently but yielded in order, as soon as available
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for r_name, r_cont in zip(region_names, executor.map(continent, region_names)):
+                yield (
+                    r_name,
+                    r_cont
+                )
 
-    return columns(headers, regions)
+    return headers, rows()
 
 def get_services(client):
-    services = []
     headers = ['ID', 'DESCRIPTION']
 
+    def description(s_id):
+        return client.get('/cloud/project/{}'.format(s_id))['description']
+
     service_ids = client.get('/cloud/project')
-    for s_id in service_ids:
-        s_desc = client.get('/cloud/project/{}'.format(s_id))['description']
-        services.append(
-            (
-                s_id,
-                s_desc if s_desc is not None else ''
-            )
-        )
 
-    return columns(headers, services)
+    def rows():
+        # details are fetched concurrently but yielded in order, as soon as available
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for s_id, s_desc in zip(service_ids, executor.map(description, service_ids)):
+                yield (
+                    s_id,
+                    s_desc if s_desc is not None else ''
+                )
+
+    return headers, rows()
 
 def get_snapshots(client):
-    snapshots = []
     headers = ['ID', 'NAME', 'USER', 'REGION']
 
     params = {}
     if client._region:
         params['region'] = client._region
 
-    for snap in client.get('/cloud/project/{}/snapshot'.format(client._project), **params):
-        snapshots.append(
-            (
+    snapshots = client.get('/cloud/project/{}/snapshot'.format(client._project), **params)
+
+    def rows():
+        for snap in snapshots:
+            yield (
                 snap['id'],
                 snap['name'],
                 snap['user'],
                 snap['region']
             )
-        )
 
-    return columns(headers, snapshots)
+    return headers, rows()
 
 def get_usage(client):
-    usage = []
     headers = ['RESOURCE', 'COST', 'TYPE']
 
     type_field = {
@@ -160,19 +176,18 @@ def get_usage(client):
     }
 
     u_hourly = client.get('/cloud/project/{}/usage/current'.format(client._project))['hourlyUsage']
-    if u_hourly is not None:
-        for _type, costs in u_hourly.items():
-            for cost in costs:
-                #usage.append((_type, cost))
-                usage.append(
-                    (
+
+    def rows():
+        if u_hourly is not None:
+            for _type, costs in u_hourly.items():
+                for cost in costs:
+                    yield (
                         _type,
                         '€{}'.format(cost['totalPrice']),
                         cost.get(type_field.get(_type), '')
                     )
-                )
 
-    return columns(headers, usage)
+    return headers, rows()
 
 def get_coreos_images(client):
     imgs = []
@@ -182,7 +197,7 @@ def get_coreos_images(client):
         'region': client._region
     }
 
-    for img in client.get('/cloud/project/{}/image'.format(client._project), **params):
+    for img in client.cached_get('/cloud/project/{}/image'.format(client._project), _persist=True, **params):
         if 'CoreOS' in img['name']:
             imgs.append(img['id'])
 
@@ -0,0 +1,117 @@
+from email.utils import parsedate_to_datetime
+from random      import uniform
+from re          import sub
+from threading   import Lock
+from time        import monotonic, sleep, time
+
+
+# methods which can safely be sent again after an unanswered request
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+
+# transient statuses worth retrying, a throttled request (429) was not processed
+# and can be retried regardless of its method
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Token bucket rate limiter
+
+    Allows bursts of up to 'burst' requests, then 'rate' requests per second.
+    A rate of 0 disables limiting.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+
+        self._tokens = self.burst
+        self._updated = monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        """Take a token, waiting until one is available"""
+
+        if not self.rate:
+            return
+
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            # tokens are taken ahead of time, waiters queue up behind each other
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait:
+            sleep(wait)
+
+
+class Metrics:
+    """Per-endpoint request statistics
+
+    Endpoints are identified by the method and the path of requests, where
+    path segments holding identifiers are replaced with '{}'.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = Lock()
+
+    def record(self, method, path, duration, retried=False, failed=False):
+        """Record a single request"""
+
+        endpoint = '{} {}'.format(method, route(path))
+
+        with self._lock:
+            # [requests, total duration, max duration, retries, errors]
+            s = self._stats.setdefault(endpoint, [0, 0.0, 0.0, 0, 0])
+            s[0] += 1
+            s[1] += duration
+            s[2] = max(s[2], duration)
+            s[3] += retried
+            s[4] += failed
+
+    def report(self):
+        """Return (endpoint, requests, avg duration, max duration, retries, errors) tuples, busiest first"""
+
+        with self._lock:
+            stats = sorted(self._stats.items(), key=lambda i: i[1][0], reverse=True)
+
+        return [(e, n, total / n, longest, retries, errors) for e, (n, total, longest, retries, errors) in stats]
+
+
+def route(path):
+    """Strip the query string and identifiers from an API path"""
+
+    return '/'.join(sub(r'.*\d.*', '{}', seg) for seg in path.split('?')[0].split('/'))
+
+def retry_delay(method, error, attempt, base=0.5, cap=30):
+    """Return the delay before retrying a failed request, or None if it must not be retried
+
+    Honours the Retry-After header of throttled responses, uses exponential
+    backoff with jitter otherwise.
+    """
+    response = getattr(error, 'response', None)
+
+    if response is None:
+        # network failure, the request may have been processed
+        if method not in IDEMPOTENT_METHODS:
+            return None
+    elif response.status_code not in RETRY_STATUSES:
+        return None
+    elif response.status_code != 429 and method not in IDEMPOTENT_METHODS:
+        return None
+    else:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return min(cap, max(0, float(retry_after)))
+            except ValueError:
+                pass
+            try:
+                return min(cap, max(0, parsedate_to_datetime(retry_after).timestamp() - time()))
+            except (TypeError, ValueError):
+                pass
+
+    return uniform(0, min(cap, base * 2**attempt))
@@ -0,0 +1,81 @@
+from contextlib import contextmanager
+from json       import dump
+from os         import getpid
+from threading  import Lock, get_ident
+from time       import perf_counter
+
+
+class Tracer:
+    """Record the duration of phases and API calls as spans
+
+    Spans are only recorded once enabled, and can be summarized or exported
+    in the Chrome trace event format (chrome://tracing, ui.perfetto.dev).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+
+        self._origin = perf_counter()
+        self._lock = Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    @contextmanager
+    def span(self, name, cat='phase', **attrs):
+        """Record the duration of the enclosed block
+
+        Yields a dict of attributes attached to the span, which the block can
+        complete, e.g. with the status of an API call.
+        """
+        if not self.enabled:
+            yield attrs
+            return
+
+        start = perf_counter()
+        try:
+            yield attrs
+        finally:
+            duration = perf_counter() - start
+            with self._lock:
+                self.spans.append((name, cat, start - self._origin, duration, get_ident(), attrs))
+
+    def summary(self):
+        """Return (category, name, count, total, max) tuples in order of first occurrence"""
+
+        stats = {}
+        with self._lock:
+            for name, cat, _, duration, _, _ in self.spans:
+                s = stats.setdefault((cat, name), [0, 0.0, 0.0])
+                s[0] += 1
+                s[1] += duration
+                s[2] = max(s[2], duration)
+
+        return [(cat, name, n, total, longest) for (cat, name), (n, total, longest) in stats.items()]
+
+    def export(self, path):
+        """Write all spans to path in the Chrome trace event format"""
+
+        pid = getpid()
+        with self._lock:
+            events = [
+                {
+                    'name': name,
+                    'cat': cat,
+                    'ph': 'X',
+                    'ts': round(start * 1e6),
+                    'dur': round(duration * 1e6),
+                    'pid': pid,
+                    'tid': tid,
+                    'args': attrs
+                }
+                for name, cat, start, duration, tid, attrs in self.spans
+            ]
+
+        with open(path, 'w') as f:
+            dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+# process-wide tracer, enabled by the --trace global option or KOVH_TRACE
+tracer = Tracer()
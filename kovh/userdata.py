@@ -1,50 +1,158 @@
-from gzip          import compress
-from urllib.parse  import quote
-from pkg_resources import resource_string
-from json          import loads, dumps
-from collections   import OrderedDict
+from base64       import b64encode
+from gzip         import compress
+from urllib.parse import quote
+from pkgutil      import get_data
+from json         import loads, dumps
+from collections  import OrderedDict
+from threading    import Lock
 
 
 def res_plain(resource):
     """Returns package data as plain bytes"""
-    return resource_string(__name__, resource)
+    return get_data(__package__, resource)
 
 def res_gzip(resource):
     """Returns package data as gzipped bytes"""
-    return compress(res_plain(resource))
+    return compress(res_plain(resource), mtime=0)
+
+
+def encode_contents(data, gzipped=False):
+    """Return the smallest Ignition 'contents' definition for data
+
+    Candidates are a percent-encoded data URL, a base64-encoded data URL and,
+    unless data is meant to be stored gzipped already, a base64-encoded data
+    URL of the gzipped data decompressed by Ignition. Percent-encoding is
+    compact for plain text but roughly triples the size of binary data.
+    """
+    candidates = [
+        {'source': 'data:,' + quote(data)},
+        {'source': 'data:;base64,' + b64encode(data).decode()}
+    ]
+    if not gzipped:
+        # no timestamp in the gzip header, identical data must give identical bytes
+        gz = compress(data, mtime=0)
+        candidates.append({'source': 'data:;base64,' + b64encode(gz).decode(), 'compression': 'gzip'})
+
+    return min(candidates, key=lambda c: len(dumps(c, separators=(',', ':'))))
+
+
+class LazyFiles:
+    """Mapping of package data loaded, and optionally gzipped, on first access
+
+    Arguments:
+    resources -- dict of name: (resource path, gzip) pairs
+    """
+
+    def __init__(self, resources):
+        self._resources = resources
+        self._loaded = {}
+        self._lock = Lock()
+
+    def __getitem__(self, name):
+        try:
+            return self._loaded[name]
+        except KeyError:
+            pass
+
+        resource, gzip = self._resources[name]
+
+        with self._lock:
+            if name not in self._loaded:
+                self._loaded[name] = res_gzip(resource) if gzip else res_plain(resource)
+
+        return self._loaded[name]
+
+    def __contains__(self, name):
+        return name in self._resources
+
+    def __iter__(self):
+        return iter(self._resources)
+
+    def __len__(self):
+        return len(self._resources)
+
 
 # Reusable data from static files
-files = {
+files = LazyFiles({
     # systemd units
-    'coremeta'                  : res_plain('data/systemd/coreos-metadata.service.d/10-provider.conf'),
-    'coremetassh'               : res_plain('data/systemd/coreos-metadata-sshkeys@.service.d/10-provider.conf'),
-    'kubelet'                   : res_plain('data/systemd/kubelet.service'),
-    'etcd'                      : res_plain('data/systemd/etcd-member.service.d/10-daemon.conf'),
-    'docker'                    : res_plain('data/systemd/docker.service.d/10-daemon.conf'),
+    'coremeta'                  : ('data/systemd/coreos-metadata.service.d/10-provider.conf', False),
+    'coremetassh'               : ('data/systemd/coreos-metadata-sshkeys@.service.d/10-provider.conf', False),
+    'kubelet'                   : ('data/systemd/kubelet.service', False),
+    'etcd'                      : ('data/systemd/etcd-member.service.d/10-daemon.conf', False),
+    'docker'                    : ('data/systemd/docker.service.d/10-daemon.conf', False),
     # k8s components manifests
-    'apiserver'                 : res_plain('data/k8s/manifests/kube-apiserver.json'),
-    'proxy'                     : res_plain('data/k8s/manifests/kube-proxy.json'),
-    'controller-manager'        : res_plain('data/k8s/manifests/kube-controller-manager.json'),
-    'scheduler'                 : res_plain('data/k8s/manifests/kube-scheduler.json'),
-    'addon-manager'             : res_gzip('data/k8s/manifests/kube-addon-manager.yml'),
+    'apiserver'                 : ('data/k8s/manifests/kube-apiserver.json', False),
+    'proxy'                     : ('data/k8s/manifests/kube-proxy.json', False),
+    'controller-manager'        : ('data/k8s/manifests/kube-controller-manager.json', False),
+    'scheduler'                 : ('data/k8s/manifests/kube-scheduler.json', False),
+    'addon-manager'             : ('data/k8s/manifests/kube-addon-manager.yml', True),
     # k8s components config
-    'kubelet-config'            : res_gzip('data/k8s/kubeletconfig.json'),
-    'proxy-config'              : res_gzip('data/k8s/kubeproxyconfig.json'),
-    'controller-manager-config' : res_gzip('data/k8s/kubecontrollermanagerconfig.json'),
-    'scheduler-config'          : res_gzip('data/k8s/kubeschedulerconfig.json'),
+    'kubelet-config'            : ('data/k8s/kubeletconfig.json', True),
+    'proxy-config'              : ('data/k8s/kubeproxyconfig.json', True),
+    'controller-manager-config' : ('data/k8s/kubecontrollermanagerconfig.json', True),
+    'scheduler-config'          : ('data/k8s/kubeschedulerconfig.json', True),
     # k8s addons manifests
-    'kubedns'                   : res_gzip('data/k8s/addons/kubedns.yml'),
-    'flannel'                   : res_gzip('data/k8s/addons/flannel.yml'),
+    'kubedns'                   : ('data/k8s/addons/kubedns.yml', True),
+    'flannel'                   : ('data/k8s/addons/flannel.yml', True),
     # k8s kubeconfig
-    'kubeconfig'                : res_plain('data/k8s/kubeconfig.json')
-}
+    'kubeconfig'                : ('data/k8s/kubeconfig.json', False)
+})
+
+
+class Fragments:
+    """Cluster-level cache of rendered User Data fragments
+
+    Most of the User Data is identical for all hosts sharing a role. Every
+    fragment is rendered, compressed and encoded once, then referenced by
+    all UserData instances sharing the same Fragments object. Fragments must
+    therefore never be modified after rendering.
+
+    When an AssetStore is provided, payloads of fragments are uploaded to it
+    and referenced by URL whenever that is smaller than embedding them.
+    """
+
+    def __init__(self, assets=None):
+        self.assets = assets
+
+        self._rendered = {}
+        self._lock = Lock()
+
+    def encode(self, data, gzipped=False):
+        """Return the smallest 'contents' definition for a shared payload"""
+
+        contents = encode_contents(data, gzipped)
+
+        if self.assets is not None:
+            # size of a reference: URL, SHA-512 digest and JSON boilerplate
+            ref_size = len(self.assets.url) + 64 + 128 + 50
+            if ref_size < len(dumps(contents, separators=(',', ':'))):
+                contents = self.assets.contents(data)
+
+        return contents
+
+    def get(self, key, render):
+        """Return the fragment stored under key, rendering it if needed"""
+
+        try:
+            return self._rendered[key]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if key not in self._rendered:
+                self._rendered[key] = render()
+
+        return self._rendered[key]
 
 
 class UserData:
 
-    def __init__(self, k8s_ver='1.12.2'):
+    def __init__(self, k8s_ver='1.12.2', fragments=None):
         self.k8s_ver = k8s_ver
 
+        # fragments shared with other hosts of the same cluster
+        self.fragments = fragments if fragments is not None else Fragments()
+
         # boilerplate ignition config
         self.data = {
             'ignition': { 'version': '2.1.0' },
@@ -63,6 +171,17 @@ class UserData:
         else:
             raise TypeError("'definition must be a list, not '{}'".format(type(definition)))
 
+    def size_report(self):
+        """Return the serialized size of every file and unit, largest first"""
+
+        report = []
+        for f in self.data['storage'].get('files', []):
+            report.append((f['path'], len(dumps(f, separators=(',', ':')))))
+        for u in self.data['systemd'].get('units', []):
+            report.append((u['name'], len(dumps(u, separators=(',', ':')))))
+
+        return sorted(report, key=lambda r: r[1], reverse=True)
+
     def add_sunits(self, definition):
         """Add elements to node systemd['units']"""
 
@@ -77,106 +196,111 @@ class UserData:
     def configure_clinux_core(self):
         """Generate drop-ins for Container Linux core services"""
 
-        self.add_sunits([
-            {
-                'name': 'coreos-metadata.service',
-                'dropins': [{
-                    'name': '10-provider.conf',
-                    'contents': files['coremeta'].decode()
-                }]
-            },
-            {
-                'name': 'coreos-metadata-sshkeys@.service',
-                'enable': True,
-                'dropins': [{
-                    'name': '10-provider.conf',
-                    'contents': files['coremetassh'].decode()
-                }]
-            },
-            {
-                'name': 'locksmithd.service',
-                'mask': True
-            }
-        ])
+        def render():
+            return [
+                {
+                    'name': 'coreos-metadata.service',
+                    'dropins': [{
+                        'name': '10-provider.conf',
+                        'contents': files['coremeta'].decode()
+                    }]
+                },
+                {
+                    'name': 'coreos-metadata-sshkeys@.service',
+                    'enable': True,
+                    'dropins': [{
+                        'name': '10-provider.conf',
+                        'contents': files['coremetassh'].decode()
+                    }]
+                },
+                {
+                    'name': 'locksmithd.service',
+                    'mask': True
+                }
+            ]
+
+        self.add_sunits(self.fragments.get('clinux-core', render))
 
     def gen_kubeconfig(self, component, server='localhost'):
         """Generate kubeconfig"""
 
-        kubeconfig = loads(files['kubeconfig'].decode(), object_pairs_hook=OrderedDict)
-        kubeconfig['users'][0]['user']['client-certificate'] = 'tls/client/{}.crt'.format(component)
-        kubeconfig['clusters'][0]['cluster']['server'] = 'https://' + server + ':6443'
+        def render():
+            kubeconfig = loads(files['kubeconfig'].decode(), object_pairs_hook=OrderedDict)
+            kubeconfig['users'][0]['user']['client-certificate'] = 'tls/client/{}.crt'.format(component)
+            kubeconfig['clusters'][0]['cluster']['server'] = 'https://' + server + ':6443'
 
-        kubeconfig = compress((dumps(kubeconfig, indent=2) + '\n').encode())
+            kubeconfig = compress((dumps(kubeconfig, indent=2) + '\n').encode(), mtime=0)
 
-        self.add_files([
-            {
-                'filesystem': 'root',
-                'path': '/etc/kubernetes/kubeconfig-' + component + '.gz',
-                'mode': 416, # 0640
-                'contents': {
-                    'source': 'data:,' + quote(kubeconfig)
+            return [
+                {
+                    'filesystem': 'root',
+                    'path': '/etc/kubernetes/kubeconfig-' + component + '.gz',
+                    'mode': 416, # 0640
+                    'contents': self.fragments.encode(kubeconfig, gzipped=True)
                 }
-            }
-        ])
+            ]
+
+        self.add_files(self.fragments.get(('kubeconfig', component, server), render))
 
     def gen_kubemanifest(self, component, tag):
         """Generate Kubernetes Pod manifest"""
 
-        manifest = loads(files[component].decode(), object_pairs_hook=OrderedDict)
-        manifest['spec']['containers'][0]['image'] = 'k8s.gcr.io/hyperkube:v{}'.format(self.k8s_ver)
+        def render():
+            manifest = loads(files[component].decode(), object_pairs_hook=OrderedDict)
+            manifest['spec']['containers'][0]['image'] = 'k8s.gcr.io/hyperkube:v{}'.format(self.k8s_ver)
 
-        manifest = compress((dumps(manifest, indent=2) + '\n').encode())
+            manifest = compress((dumps(manifest, indent=2) + '\n').encode(), mtime=0)
 
-        self.add_files([
-            {
-                'filesystem': 'root',
-                'path': '/etc/kubernetes/manifests/kube-{}.json'.format(component) + '.gz',
-                'mode': 416, # 0640
-                'contents': {
-                    'source': 'data:,' + quote(manifest)
+            return [
+                {
+                    'filesystem': 'root',
+                    'path': '/etc/kubernetes/manifests/kube-{}.json'.format(component) + '.gz',
+                    'mode': 416, # 0640
+                    'contents': self.fragments.encode(manifest, gzipped=True)
                 }
-            }
-        ])
+            ]
+
+        self.add_files(self.fragments.get(('kubemanifest', component, self.k8s_ver), render))
 
     def gen_kubelet_unit(self, roles):
         """Generate kubelet service unit"""
 
-        labels = ("node-role.kubernetes.io/{}=''".format(r) for r in roles)
+        def render():
+            labels = ("node-role.kubernetes.io/{}=''".format(r) for r in roles)
+
+            return [
+                {
+                    'name': 'kubelet.service',
+                    'enable': True,
+                    'contents': (
+                        files['kubelet'].decode()
+                        .replace('__IMAGE_TAG__', 'v{}'.format(self.k8s_ver))
+                        .replace('__NODE_LABELS__', ','.join(labels)))
+                }
+            ]
 
-        self.add_sunits([
-            {
-                'name': 'kubelet.service',
-                'enable': True,
-                'contents': (
-                    files['kubelet'].decode()
-                    .replace('__IMAGE_TAG__', 'v{}'.format(self.k8s_ver))
-                    .replace('__NODE_LABELS__', ','.join(labels)))
-            }
-        ])
+        self.add_sunits(self.fragments.get(('kubelet-unit', tuple(roles), self.k8s_ver), render))
 
-    def gen_etc_hosts(self, client, net):
-        """Generate /etc/hosts file containing all subnet hosts
+    def gen_etc_hosts(self, ips):
+        """Generate /etc/hosts file containing all cluster hosts
 
         Makes it possible to register k8s nodes by hostname.
         Disgusting hack to make up for OVH's terrible DNS.
         """
-        from ipaddress import IPv4Network
-
-        subnet = client.get('/cloud/project/{}/network/private/{}/subnet'.format(client._project, net))[0]
-        hosts = IPv4Network(subnet['cidr']).hosts()
-        hosts_content = ('127.0.0.1\tlocalhost\n' + '::1\t\tlocalhost\n' +
-             '\n'.join(['{}\t{}'.format(ip, 'host-'+str(ip).replace('.', '-')) for ip in hosts]) + '\n').encode()
-
-        self.add_files([
-            {
-                'filesystem': 'root',
-                'path': '/etc/hosts',
-                'mode': 420, # 0644
-                'contents': {
-                    'source': 'data:,' + quote(hosts_content)
+        def render():
+            hosts_content = ('127.0.0.1\tlocalhost\n' + '::1\t\tlocalhost\n' +
+                 '\n'.join(['{}\t{}'.format(ip, 'host-'+ip.replace('.', '-')) for ip in ips]) + '\n').encode()
+
+            return [
+                {
+                    'filesystem': 'root',
+                    'path': '/etc/hosts',
+                    'mode': 420, # 0644
+                    'contents': self.fragments.encode(hosts_content)
                 }
-            }
-        ])
+            ]
+
+        self.add_files(self.fragments.get(('etc-hosts', tuple(ips)), render))
 
     def gen_kube_data(self, roles):
         """Generate data deployed to all Kubernetes instances"""
@@ -184,101 +308,98 @@ class UserData:
         self.gen_kubelet_unit(roles)
         self.gen_kubemanifest('proxy', 'v{}'.format(self.k8s_ver))
 
-        self.add_files([
-            {
-                'filesystem': 'root',
-                'path': '/etc/kubernetes/kubeletconfig.gz',
-                'mode': 416, # 0640
-                'contents': {
-                    'source': 'data:,' + quote(files['kubelet-config'])
-                }
-            },
-            {
-                'filesystem': 'root',
-                'path': '/etc/kubernetes/kubeproxyconfig.gz',
-                'mode': 416, # 0640
-                'contents': {
-                    'source': 'data:,' + quote(files['proxy-config'])
+        def render_files():
+            return [
+                {
+                    'filesystem': 'root',
+                    'path': '/etc/kubernetes/kubeletconfig.gz',
+                    'mode': 416, # 0640
+                    'contents': self.fragments.encode(files['kubelet-config'], gzipped=True)
+                },
+                {
+                    'filesystem': 'root',
+                    'path': '/etc/kubernetes/kubeproxyconfig.gz',
+                    'mode': 416, # 0640
+                    'contents': self.fragments.encode(files['proxy-config'], gzipped=True)
                 }
-            }
-        ])
+            ]
 
         # configure Docker daemon
-        self.add_sunits([
-            {
-                'name': 'docker.service',
-                'dropins': [{
-                    'name': '10-daemon.conf',
-                    'contents': files['docker'].decode()
-                }]
-            }
-        ])
+        def render_sunits():
+            return [
+                {
+                    'name': 'docker.service',
+                    'dropins': [{
+                        'name': '10-daemon.conf',
+                        'contents': files['docker'].decode()
+                    }]
+                }
+            ]
+
+        self.add_files(self.fragments.get('kube-files', render_files))
+        self.add_sunits(self.fragments.get('kube-sunits', render_sunits))
 
     def gen_kubemaster_data(self):
         """Generate data deployed to all Kubernetes masters"""
 
-        self.add_sunits([
-            {
-                'name': 'etcd-member.service',
-                'enable': True,
-                'dropins': [{
-                    'name': '10-daemon.conf',
-                    'contents': files['etcd'].decode()
-                }]
-            }
-        ])
+        def render_sunits():
+            return [
+                {
+                    'name': 'etcd-member.service',
+                    'enable': True,
+                    'dropins': [{
+                        'name': '10-daemon.conf',
+                        'contents': files['etcd'].decode()
+                    }]
+                }
+            ]
+
+        self.add_sunits(self.fragments.get('kubemaster-sunits', render_sunits))
 
         for component in 'apiserver', 'scheduler', 'controller-manager':
             self.gen_kubemanifest(component, 'v{}'.format(self.k8s_ver))
 
-        self.add_files([
-            {
-                'filesystem': 'root',
-                'path': '/etc/kubernetes/kubecontrollermanagerconfig.gz',
-                'mode': 416, # 0640
-                'contents': {
-                    'source': 'data:,' + quote(files['controller-manager-config'])
+        def render_files():
+            return [
+                {
+                    'filesystem': 'root',
+                    'path': '/etc/kubernetes/kubecontrollermanagerconfig.gz',
+                    'mode': 416, # 0640
+                    'contents': self.fragments.encode(files['controller-manager-config'], gzipped=True)
+                },
+                {
+                    'filesystem': 'root',
+                    'path': '/etc/kubernetes/kubeschedulerconfig.gz',
+                    'mode': 416, # 0640
+                    'contents': self.fragments.encode(files['scheduler-config'], gzipped=True)
+                },
+                {
+                    'filesystem': 'root',
+                    'path': '/etc/kubernetes/manifests/kube-addon-manager.yml' + '.gz',
+                    'mode': 416, # 0640
+                    'contents': self.fragments.encode(files['addon-manager'], gzipped=True)
+                },
+                {
+                    'filesystem': 'root',
+                    'path': '/etc/kubernetes/addons/kubedns.yml' + '.gz',
+                    'mode': 416, # 0640
+                    'contents': self.fragments.encode(files['kubedns'], gzipped=True)
+                },
+                {
+                    'filesystem': 'root',
+                    'path': '/etc/kubernetes/addons/flannel.yml' + '.gz',
+                    'mode': 416, # 0640
+                    'contents': self.fragments.encode(files['flannel'], gzipped=True)
+                },
+                {
+                    'filesystem': 'root',
+                    'path': '/opt/bin/kubectl',
+                    'mode': 493, # 0755
+                    'contents': {
+                        'source': ('https://storage.googleapis.com/kubernetes-release/release/'
+                                   'v{}/bin/linux/amd64/kubectl').format(self.k8s_ver)
+                    }
                 }
-            },
-            {
-                'filesystem': 'root',
-                'path': '/etc/kubernetes/kubeschedulerconfig.gz',
-                'mode': 416, # 0640
-                'contents': {
-                    'source': 'data:,' + quote(files['scheduler-config'])
-                }
-            },
-            {
-                'filesystem': 'root',
-                'path': '/etc/kubernetes/manifests/kube-addon-manager.yml' + '.gz',
-                'mode': 416, # 0640
-                'contents': {
-                    'source': 'data:,' + quote(files['addon-manager'])
-                }
-            },
-            {
-                'filesystem': 'root',
-                'path': '/etc/kubernetes/addons/kubedns.yml' + '.gz',
-                'mode': 416, # 0640
-                'contents': {
-                    'source': 'data:,' + quote(files['kubedns'])
-                }
-            },
-            {
-                'filesystem': 'root',
-                'path': '/etc/kubernetes/addons/flannel.yml' + '.gz',
-                'mode': 416, # 0640
-                'contents': {
-                    'source': 'data:,' + quote(files['flannel'])
-                }
-            },
-            {
-                'filesystem': 'root',
-                'path': '/opt/bin/kubectl',
-                'mode': 493, # 0755
-                'contents': {
-                    'source': ('https://storage.googleapis.com/kubernetes-release/release/'
-                               'v{}/bin/linux/amd64/kubectl').format(self.k8s_ver)
-                }
-            }
-        ])
+            ]
+
+        self.add_files(self.fragments.get(('kubemaster-files', self.k8s_ver), render_files))
@@ -1,31 +1,115 @@
+from csv     import writer as csv_writer
+from json    import dumps
+from os      import environ, makedirs
+from os.path import expanduser, join
+import sys
+
+try:
+    from fcntl import flock, LOCK_EX, LOCK_UN
+except ImportError:
+    flock = None
+
+
+# formats supported by write_rows()
+OUTPUT_FORMATS = ('table', 'json', 'jsonl', 'csv')
+
+
 def columns(headers, data):
     """Format input into columns
 
     Arguments:
     headers -- list or tuple of header strings
-    data -- list of data tuples
+    data -- iterable of data tuples
+
+    Every value is converted to a string once, and column sizes are computed
+    while reading the data.
     """
-    # add headers to data set
-    data.insert(0, headers)
+    col_size = [len(h) for h in headers]
 
-    # populate column sizes
-    col_size = []
+    rows = [headers]
     for d in data:
+        d = [str(v) for v in d]
         for i, v in enumerate(d):
             try:
-                if len(str(v)) > col_size[i]:
+                if len(v) > col_size[i]:
                     col_size[i] = len(v)
             except IndexError:
                 col_size.append(len(v))
+        rows.append(d)
 
     # generate format strings
     fmt = []
     for width in col_size:
         fmt.append('{{:<{}}}'.format(width))
 
-    # populate formatted lines
-    lines = []
-    for d in data:
-        lines.append('  '.join(fmt[:len(d)]).format(*d))
+    return '\n'.join('  '.join(fmt[:len(d)]).format(*d) for d in rows)
+
+def write_rows(headers, rows, fmt='table', out=None):
+    """Write a listing in the given output format
+
+    Arguments:
+    headers -- list or tuple of header strings
+    rows -- iterable of data tuples
+    fmt -- one of OUTPUT_FORMATS
+    out -- file object, defaults to the current standard output
+
+    The 'jsonl' and 'csv' formats write every row as soon as it is read,
+    'table' and 'json' need all rows to be read first.
+    """
+    if fmt == 'table':
+        print(columns(headers, rows), file=out)
+        return
+
+    keys = [h.lower().replace(' ', '_') for h in headers]
+
+    if fmt == 'json':
+        print(dumps([dict(zip(keys, r)) for r in rows], indent=4), file=out)
+    elif fmt == 'jsonl':
+        for r in rows:
+            print(dumps(dict(zip(keys, r))), file=out, flush=True)
+    elif fmt == 'csv':
+        out = out if out is not None else sys.stdout
+        writer = csv_writer(out)
+        writer.writerow(headers)
+        for r in rows:
+            writer.writerow(r)
+            out.flush()
+    else:
+        raise ValueError("output format must be one of {}, not '{}'".format(', '.join(OUTPUT_FORMATS), fmt))
+
+def data_dir():
+    """Return the directory holding kovh's persistent local data
+
+    Follows the XDG base directory specification, the directory is created
+    with restrictive permissions if it doesn't exist.
+    """
+    path = join(environ.get('XDG_DATA_HOME') or expanduser('~/.local/share'), 'kovh')
+    makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+def cache_dir():
+    """Return the directory holding kovh's disposable cached data
+
+    Follows the XDG base directory specification, the directory is not created.
+    """
+    return join(environ.get('XDG_CACHE_HOME') or expanduser('~/.cache'), 'kovh')
+
+
+class LockedFile:
+    """Context manager holding an advisory lock on an open file
+
+    Locking is a no-op on platforms without fcntl.
+    """
+
+    def __init__(self, f):
+        self._f = f
+
+    def __enter__(self):
+        if flock is not None:
+            flock(self._f, LOCK_EX)
+        return self._f
 
-    return '\n'.join(lines)
+    def __exit__(self, *exc):
+        if flock is not None:
+            flock(self._f, LOCK_UN)
+        self._f.close()
@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+from random             import uniform
+from time               import monotonic, sleep
+
+
+def wait(resources, check, timeout=600, resource_timeout=None, interval=1, max_interval=30, parallelism=8,
+         progress=None):
+    """Poll many resources concurrently until they reach the expected state
+
+    Arguments:
+    resources -- iterable of resource identifiers
+    check -- callable returning True once the given resource is ready
+    timeout -- overall deadline in seconds
+    resource_timeout -- deadline in seconds for each resource, either a number
+                        or a dict mapping resources to their own deadline
+    interval -- initial polling delay, doubled after every attempt
+    max_interval -- upper bound of the polling delay
+    parallelism -- maximum number of concurrent checks
+    progress -- callable invoked after every polling round
+
+    Each resource is polled on its own schedule using exponential backoff with
+    jitter. Returns the list of resources which were still pending when their
+    deadline expired, which is empty on success.
+    """
+    start = monotonic()
+    deadline = start + timeout
+
+    def res_deadline(r):
+        t = resource_timeout.get(r) if isinstance(resource_timeout, dict) else resource_timeout
+        return min(deadline, start + t) if t is not None else deadline
+
+    # resource -> [next poll time, current interval, deadline]
+    pending = {r: [start, interval, res_deadline(r)] for r in resources}
+    expired = []
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        while pending:
+            now = monotonic()
+
+            for r in [r for r, (_, _, d) in pending.items() if now >= d]:
+                del pending[r]
+                expired.append(r)
+
+            due = [r for r, (t, _, _) in pending.items() if t <= now]
+            for r, ready in zip(due, executor.map(check, due)):
+                if ready:
+                    del pending[r]
+                else:
+                    delay = pending[r][1]
+                    pending[r][0] = monotonic() + uniform(delay / 2, delay)
+                    pending[r][1] = min(delay * 2, max_interval)
+
+            if due and progress is not None:
+                progress()
+
+            if pending:
+                wake = min(min(t, d) for t, _, d in pending.values())
+                sleep(max(0, wake - monotonic()))
+
+    return expired
@@ -21,9 +21,11 @@ setup(
 
     # Dependencies
     install_requires=[
+        'cryptography>=1.9',
         'docopt>=0.6.2',
         'ovh>=0.4.7',
-        'pyOpenSSL>=17.0.0'
+        'pyOpenSSL>=17.0.0',
+        'requests>=2.11'
     ],
 
     # Script info